@@ -1 +1,2 @@
 # Sept. 27, 2013
+default_app_config = 'fabric_bolt.core.apps.CoreConfig'
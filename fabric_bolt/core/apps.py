@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class CoreConfig(AppConfig):
+    name = 'fabric_bolt.core'
+    verbose_name = 'Core'
+
+    def ready(self):
+        # The sidebar's models have to be loaded before their signals can be connected
+        from fabric_bolt.core.receivers import connect_sidebar_receivers
+        connect_sidebar_receivers()
@@ -1,14 +1,63 @@
+from collections import namedtuple
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.functional import cached_property
 
 from fabric_bolt.hosts.models import Host
 from fabric_bolt.projects.models import Project
 from fabric_bolt.web_hooks.models import Hook
 
 
+# Sidebar lists only change when one of these is saved or deleted, see receivers.invalidate_sidebar_lists
+SIDEBAR_CACHE_TIMEOUT = 60 * 60
+
+
+class SidebarItem(namedtuple('SidebarItem', ['pk', 'name'])):
+    """The little the sidebar shows of an object: links to its pk, labelled with its name"""
+
+    __slots__ = ()
+
+    def __unicode__(self):
+        return self.name
+
+
+class SidebarList(object):
+    """A cached list of SidebarItems, only fetched once a template iterates over it"""
+
+    def __init__(self, cache_key, queryset):
+        self.cache_key = cache_key
+        self.queryset = queryset
+
+    @cached_property
+    def items(self):
+        items = cache.get(self.cache_key)
+
+        if items is None:
+            items = [SidebarItem(obj.pk, unicode(obj)) for obj in self.queryset()]
+            cache.set(self.cache_key, items, SIDEBAR_CACHE_TIMEOUT)
+
+        return items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+# The model each list shows, as 'app_label.ModelName', and the queryset it's fetched with
+SIDEBAR_LISTS = {
+    'sidebar_hosts': ('hosts.Host', lambda: Host.objects.all()),
+    'sidebar_projects': ('projects.Project', lambda: Project.active_records.all()),
+    'sidebar_users': (settings.AUTH_USER_MODEL, lambda: get_user_model().objects.all()),
+    'system_hooks': ('web_hooks.Hook', lambda: Hook.objects.filter(project=None)),
+}
+
+
 def sidebar_lists(request):
     context = {}
-    context['sidebar_hosts'] = Host.objects.all()
-    context['sidebar_projects'] = Project.active_records.all()
-    context['sidebar_users'] = get_user_model().objects.all()
-    context['system_hooks'] = Hook.objects.filter(project=None)
+    for name, (model, queryset) in SIDEBAR_LISTS.items():
+        context[name] = SidebarList('sidebar_lists_{}'.format(name), queryset)
     return context
@@ -2,9 +2,12 @@ from __future__ import absolute_import, unicode_literals
 
 from django.core.paginator import Paginator
 from django.core import urlresolvers
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
 from django.utils.html import mark_safe, escape
 
 import django_tables2 as tables
+from django_tables2.rows import BoundRows
 from django_tables2.tables import Table
 from django_tables2.utils import Accessor as A, AttributeDict
 
@@ -57,14 +60,61 @@ class ActionsColumn(tables.Column):
         return mark_safe(self.delimiter.join(links))
 
 
+def encode_cursor(direction, value, pk):
+    return '{}{}_{}'.format(direction, pk, value.isoformat())
+
+
+def decode_cursor(cursor):
+    """Returns (direction, value, pk) from a cursor made by encode_cursor, None if it isn't valid"""
+
+    try:
+        pk, value = cursor[1:].split('_', 1)
+        value = parse_datetime(value)
+        pk = int(pk)
+    except (TypeError, ValueError):
+        return None
+
+    if cursor[0] not in 'np' or value is None:
+        return None
+
+    return cursor[0], value, pk
+
+
+class CursorPage(object):
+    """A page of a table paginated by cursor, see PaginateTable.paginate_by_cursor"""
+
+    def __init__(self, object_list, previous_cursor, next_cursor, count, count_is_estimate):
+        self.object_list = object_list
+        self.previous_cursor = previous_cursor
+        self.next_cursor = next_cursor
+        self.count = count
+        self.count_is_estimate = count_is_estimate
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+
 class PaginateTable(Table):
     """Generic table class that makes use of Django's built in paginate functionality"""
 
+    # Date time field cursor pagination orders the rows by, newest first, with the primary key as tie breaker
+    cursor_field = 'date_created'
+    # Rows are only counted up to here in cursor pagination, past it the count is shown as an estimate
+    cursor_count_limit = 1000
+
     def __init__(self, *args, **kwargs):
         super(PaginateTable, self).__init__(*args, **kwargs)
         self.template = kwargs.get('template', 'fancy_paged_tables/table.html')
+        self.cursor_paginated = False
 
-    def paginate(self, klass=Paginator, per_page=None, page=1, *args, **kwargs):
+    @property
+    def prefixed_cursor_field(self):
+        return '{}cursor'.format(self.prefix or '')
+
+    def paginate(self, klass=Paginator, per_page=None, page=1, cursor_pagination=False, cursor=None, *args, **kwargs):
         """
         Paginates the table using a paginator and creates a ``page`` property
         containing information for the current page.
@@ -75,6 +125,11 @@ class PaginateTable(Table):
         :param per_page: how many records are displayed on each page
         :type      page: `int`
         :param     page: which page should be displayed.
+        :type  cursor_pagination: `bool`
+        :param cursor_pagination: paginate by cursor instead, see `paginate_by_cursor`.
+                                  Tables sorted on one of their columns still use pages.
+        :type    cursor: `unicode`
+        :param   cursor: the cursor of the page to display, None for the first one.
 
         Extra arguments are passed to the paginator.
 
@@ -86,6 +141,9 @@ class PaginateTable(Table):
         self.per_page_options = [20, 50, 100, 200]  # This should probably be a passed in option
         self.per_page = per_page = per_page or self._meta.per_page
 
+        if cursor_pagination and not self.order_by:
+            return self.paginate_by_cursor(per_page, cursor)
+
         self.paginator = klass(self.rows, per_page, *args, **kwargs)
         self.page = self.paginator.page(page)
 
@@ -105,4 +163,56 @@ class PaginateTable(Table):
         # Paging vars used in template
         self.page_numbers = [n for n in range(start_page, end_page) if 0 < n <= self.paginator.num_pages]
         self.show_first = 1 not in self.page_numbers
-        self.show_last = self.paginator.num_pages not in self.page_numbers
\ No newline at end of file
+        self.show_last = self.paginator.num_pages not in self.page_numbers
+
+    def paginate_by_cursor(self, per_page, cursor=None):
+        """
+        Paginates the table newest first by (cursor_field, pk) ranges instead of OFFSETs, so with an index on
+        cursor_field any page costs the same as the first one. There are only previous and next links, and the row
+        count stops at cursor_count_limit.
+
+        Creates a ``page`` property containing a `CursorPage`.
+        """
+
+        queryset = self.data.queryset
+        field = self.cursor_field
+        decoded = decode_cursor(cursor) if cursor else None
+
+        if decoded is None:
+            records = list(queryset.order_by('-' + field, '-pk')[:per_page + 1])
+            has_previous = False
+            has_next = len(records) > per_page
+            records = records[:per_page]
+        elif decoded[0] == 'n':
+            direction, value, pk = decoded
+            records = list(
+                queryset.filter(Q(**{field + '__lt': value}) | Q(**{field: value, 'pk__lt': pk}))
+                .order_by('-' + field, '-pk')[:per_page + 1]
+            )
+            has_previous = True
+            has_next = len(records) > per_page
+            records = records[:per_page]
+        else:
+            direction, value, pk = decoded
+            records = list(
+                queryset.filter(Q(**{field + '__gt': value}) | Q(**{field: value, 'pk__gt': pk}))
+                .order_by(field, 'pk')[:per_page + 1]
+            )
+            has_previous = len(records) > per_page
+            has_next = True
+            records = records[:per_page][::-1]
+
+        if not records and decoded is not None:
+            # Stale cursor, the rows around it are gone
+            return self.paginate_by_cursor(per_page)
+
+        count = queryset.order_by()[:self.cursor_count_limit + 1].count()
+
+        self.cursor_paginated = True
+        self.page = CursorPage(
+            BoundRows(records, table=self),
+            encode_cursor('p', getattr(records[0], field), records[0].pk) if has_previous else None,
+            encode_cursor('n', getattr(records[-1], field), records[-1].pk) if has_next else None,
+            min(count, self.cursor_count_limit),
+            count > self.cursor_count_limit
+        )
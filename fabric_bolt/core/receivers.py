@@ -0,0 +1,22 @@
+from django.apps import apps
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+
+from fabric_bolt.core.context_processors import SIDEBAR_LISTS
+
+
+def invalidate_sidebar_lists(sender, **kwargs):
+    """Drop the cached sidebar lists showing the model that was saved or deleted"""
+
+    model = '{}.{}'.format(sender._meta.app_label, sender._meta.object_name)
+    cache.delete_many(['sidebar_lists_{}'.format(name) for name, (list_model, queryset) in SIDEBAR_LISTS.items()
+                       if list_model == model])
+
+
+def connect_sidebar_receivers():
+    """Connect invalidate_sidebar_lists to the saves and deletes of only the models the sidebar lists show"""
+
+    for label in set(model for model, queryset in SIDEBAR_LISTS.values()):
+        model = apps.get_model(label)
+        post_save.connect(invalidate_sidebar_lists, sender=model, dispatch_uid='sidebar_lists_{}'.format(label))
+        post_delete.connect(invalidate_sidebar_lists, sender=model, dispatch_uid='sidebar_lists_{}'.format(label))
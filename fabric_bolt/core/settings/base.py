@@ -108,6 +108,38 @@ STATICFILES_FINDERS = (
 
 SOCKETIO_ENABLED = False
 
+# Run deployments in the worker pool started by `manage.py run_deployment_workers` instead of in the web processes
+DEPLOYMENT_QUEUE_ENABLED = False
+DEPLOYMENT_WORKERS = 4
+# How many deployments the pool runs against the same host at once, 0 for no limit
+DEPLOYMENT_WORKERS_PER_HOST = 1
+# Running deployments whose worker hasn't checked in for this many seconds are failed, freeing their hosts
+DEPLOYMENT_HEARTBEAT_TIMEOUT = 60
+
+# Refuse to start deployments while none of the launch windows is open. Has no effect if there are no launch windows.
+LAUNCH_WINDOWS_REQUIRED = False
+
+# Web hooks are POSTed by a pool of this many threads per process, reusing connections to the same host
+HOOK_THREADS = 3
+# Seconds to wait for a web hook target to accept the connection, and to respond
+HOOK_TIMEOUT = (5, 30)
+
+# Failed web hook deliveries are retried by `manage.py deliver_web_hooks` after HOOK_RETRY_DELAY seconds, doubling
+# every attempt up to HOOK_RETRY_MAX_DELAY, until HOOK_MAX_ATTEMPTS have failed
+HOOK_MAX_ATTEMPTS = 8
+HOOK_RETRY_DELAY = 30
+HOOK_RETRY_MAX_DELAY = 60 * 60
+# Delivered and given up deliveries are deleted by `manage.py deliver_web_hooks` after this many seconds, None to keep
+# them forever
+HOOK_DELIVERY_RETENTION = 60 * 60 * 24 * 30
+# Most web hooks per second each process sends to the same host, 0 for no limit
+HOOK_RATE_LIMIT = 0
+# Where Fabric Bolt is served, e.g. 'https://deploy.example.com'. Web hook payloads only link to the full deployment
+# output when it's set. The link carries a token that lets whoever has it read the output without logging in, for
+# HOOK_OUTPUT_URL_MAX_AGE seconds.
+HOOK_BASE_URL = None
+HOOK_OUTPUT_URL_MAX_AGE = 60 * 60 * 24 * 7
+
 ########## TEMPLATE CONFIGURATION
 GRAPPELLI_ADMIN_TITLE = 'Admin'
 
@@ -177,6 +209,7 @@ INSTALLED_APPS = (
     'graphos',
     'django_activeurl',
     # Project
+    'fabric_bolt.core',
     'fabric_bolt.accounts',
     'fabric_bolt.hosts',
     'fabric_bolt.launch_window',
@@ -187,6 +220,8 @@ INSTALLED_APPS = (
 ########## END APP CONFIGURATION
 
 FABFILE_PATH = os.path.join(os.path.dirname(PROJECT_DIR), 'fabfile.py')
+# The python, with Fabric installed, that loads fabfiles run without a virtualenv. Found on the PATH like fab is.
+FABRIC_PYTHON = 'python'
 
 ########## STRONGHOLD CONFIGURATION
 LOGIN_URL = '/login/'
@@ -199,7 +234,8 @@ STRONGHOLD_PUBLIC_NAMED_URLS = (
 )
 STRONGHOLD_PUBLIC_URLS = (
     r'^/reset/[0-9A-Za-z_\-]+/[0-9A-Za-z]{1,13}-[0-9A-Za-z]{1,20}/',
-    r'^/api/v1/.*'
+    r'^/api/v1/.*',
+    r'^/projects/\w+/stage/\d+/deployment/\d+/log/$',  # Checks the login, or the token web hooks get, itself
 )
 ########## END STRONGHOLD CONFIGURATION
 
@@ -284,4 +320,12 @@ CACHES = {
 }
 
 
+# How long a project's repo checkout is trusted before pulling it again. Task lists are cached by fabfile digest and
+# never expire.
 FABRIC_TASK_CACHE_TIMEOUT = 60 * 60 * 24  # one day
+
+# Set when prewarm_fabfiles runs periodically (with an --interval shorter than FABRIC_TASK_CACHE_TIMEOUT): pages then
+# only read the task lists it cached and never pull repos, install requirements or load fabfiles themselves. Projects
+# it hasn't warmed yet show no tasks. This needs a real cache shared by the command and the web processes, such as
+# memcached: with the DummyCache 'default' above nothing is ever cached, so no page would show any task.
+FABRIC_TASKS_PREWARMED = False
@@ -1,5 +1,9 @@
 # Local settings for core project.
 LOCAL_SETTINGS = True
+import atexit
+import shutil
+import tempfile
+
 from fabric_bolt.core.settings.base import *
 
 DEBUG = True
@@ -18,6 +22,10 @@ DATABASES = {
     }
 }
 
+# Locks, repo checkouts and virtualenvs made by the tests stay out of the source tree
+PUBLIC_DIR = tempfile.mkdtemp(prefix='fabric-bolt-test-')
+atexit.register(shutil.rmtree, PUBLIC_DIR, ignore_errors=True)
+
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = '3(-(r&DUMMYKEYFIRJUNK@@#@#d=48-5p&(f'
 
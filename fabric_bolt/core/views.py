@@ -1,7 +1,7 @@
 from datetime import timedelta, datetime
 
 from django.utils import timezone
-from django.db.models.aggregates import Count
+from django.db.models.aggregates import Sum
 from django.contrib import messages
 from django.views.generic import TemplateView
 from django.template.defaultfilters import date as format_date
@@ -9,10 +9,9 @@ from django.template.defaultfilters import time as format_time
 
 from graphos.renderers.gchart import PieChart, LineChart
 from graphos.sources.simple import SimpleDataSource
-from croniter import croniter
 
-from fabric_bolt.launch_window.models import LaunchWindow
-from fabric_bolt.projects.models import Project, Deployment
+from fabric_bolt.launch_window.schedule import launch_window_schedule
+from fabric_bolt.projects.models import Project, DeploymentStats
 
 
 class Dashboard(TemplateView):
@@ -23,25 +22,18 @@ class Dashboard(TemplateView):
         context = super(Dashboard, self).get_context_data(**kwargs)
 
         # Warn the user if we don't have an available Launch Window
-        has_one_window = False
-        next_window = None
-        launch_windows = LaunchWindow.objects.all()
+        launch_windows = launch_window_schedule.get_status()
 
-        for window in launch_windows:
-            current_date = datetime.now()
-
-            next_window = croniter(window.cron_format, current_date).get_next(datetime)
-            if (next_window - datetime.now()).seconds < 61:
-                has_one_window = True
-                break
-
-        if not has_one_window and launch_windows.exists():
-            messages.add_message(self.request, messages.ERROR,
-                'No available Launch Windows! Next window on %s @ %s' % (format_date(next_window), format_time(next_window)))
+        if launch_windows.has_windows and not launch_windows.is_open:
+            message = 'No available Launch Windows!'
+            if launch_windows.next_open:
+                message += ' Next window on %s @ %s' % (format_date(launch_windows.next_open),
+                                                        format_time(launch_windows.next_open))
+            messages.add_message(self.request, messages.ERROR, message)
 
         # Deployment Stats Data
         # Build pie chart data to show % projects deployed successfully
-        deployments = Deployment.active_records.order_by('status').values('status').annotate(count=Count('id'))
+        deployments = DeploymentStats.active_records.order_by('status').values('status').annotate(count=Sum('count'))
         items = [['string', 'number']] + [
             [item['status'], item['count']] for item in deployments
         ]
@@ -55,35 +47,23 @@ class Dashboard(TemplateView):
         if len(projects) == 0:
             return context
 
-        deploys = list(Deployment.objects.select_related('stage').order_by('date_created'))
-
         # Get the date range for all the deployments ever done
         start_date = (timezone.now() - timedelta(days=45)).date()
         end_date = timezone.now().date()
 
-        # Step through each day and create an array of deployment counts from each project
-        # this would be much easier if we could aggregate by day.
-        # once we can use django 1.7, we could write a __date transform. Then it would work.
-        for day in range(-1, (end_date - start_date).days + 1):
-            date = start_date + timedelta(days=day)
-            if day == -1:
-                data = ['Day']
-            else:
-                data = [date.strftime('%m/%d')]
+        # Deployment counts per project and day
+        counts = {}
+        recent_stats = DeploymentStats.active_records.filter(day__gte=start_date).order_by()\
+            .values('project', 'day').annotate(count=Sum('count'))
+        for row in recent_stats:
+            counts[row['project'], row['day']] = row['count']
 
-            for project in projects:
-                if day == -1:
-                    data.append(project.name)
-                    continue
+        chart_data = [['Day'] + [project.name for project in projects]]
 
-                count = 0
-                for d in deploys:
-                    if d.stage.project_id == project.pk and d.date_created.date() == date:
-                        count += 1
-
-                data.append(count)
-
-            chart_data.append(data)
+        # Step through each day and create an array of deployment counts from each project
+        for day in range((end_date - start_date).days + 1):
+            date = start_date + timedelta(days=day)
+            chart_data.append([date.strftime('%m/%d')] + [counts.get((project.pk, date), 0) for project in projects])
 
         context['line_chart'] = LineChart(SimpleDataSource(chart_data), width='100%', height=300, options={'title': ''})
 
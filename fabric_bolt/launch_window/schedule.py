@@ -0,0 +1,109 @@
+"""
+When launch windows are open, worked out ahead of time so pages don't evaluate every cron entry on every request
+"""
+
+import bisect
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from croniter import croniter
+
+from fabric_bolt.launch_window.models import LaunchWindow
+
+logger = logging.getLogger(__name__)
+
+# Launch windows are cron entries, each time one fires the window is open for that minute
+FIRING_LENGTH = timedelta(minutes=1)
+
+LaunchWindowStatus = namedtuple('LaunchWindowStatus', ['has_windows', 'is_open', 'next_open'])
+
+
+class LaunchWindowSchedule(object):
+    """
+    The times any launch window is open from now until `horizon` ahead, as sorted, non overlapping intervals.
+
+    The intervals are recomputed when the launch windows change or half of the horizon has passed, in between
+    checking a time is a binary search. Times are local and naive, like the cron entries.
+    """
+
+    def __init__(self, horizon=timedelta(days=1)):
+        self.horizon = horizon
+        self.lock = threading.Lock()
+
+        self.windows = None
+        self.refresh_at = None
+        self.starts = []
+        self.ends = []
+
+    def get_status(self, now=None):
+        """Whether there are launch windows, whether one is open at `now` and when one next opens"""
+
+        now = now or datetime.now()
+        windows = list(LaunchWindow.objects.order_by('pk').values_list('pk', 'cron_format'))
+
+        with self.lock:
+            if windows != self.windows or now >= self.refresh_at:
+                self.build(windows, now)
+
+            starts, ends = self.starts, self.ends
+
+        index = bisect.bisect_right(starts, now) - 1
+
+        if index >= 0 and now < ends[index]:
+            return LaunchWindowStatus(True, True, now)
+
+        next_open = starts[index + 1] if index + 1 < len(starts) else None
+        return LaunchWindowStatus(bool(windows), False, next_open)
+
+    def build(self, windows, now):
+        start = now.replace(second=0, microsecond=0)
+        end = start + self.horizon
+
+        intervals = []
+        for pk, cron_format in windows:
+            if not cron_format:
+                continue
+
+            try:
+                intervals.extend(get_open_intervals(cron_format, start, end))
+            except (ValueError, KeyError):
+                logger.warning('Launch window %s has an invalid cron format: %r', pk, cron_format)
+
+        intervals.sort()
+
+        starts, ends = [], []
+        for interval_start, interval_end in intervals:
+            if ends and interval_start <= ends[-1]:
+                ends[-1] = max(ends[-1], interval_end)
+            else:
+                starts.append(interval_start)
+                ends.append(interval_end)
+
+        self.windows = windows
+        self.refresh_at = start + self.horizon // 2
+        self.starts, self.ends = starts, ends
+
+
+def get_open_intervals(cron_format, start, end):
+    """The [open, close) intervals of a cron entry from start to end, and the first one after end"""
+
+    intervals = []
+
+    # get_next only returns times after the one it starts from
+    iterator = croniter(cron_format, start - timedelta(seconds=1))
+
+    while True:
+        firing = iterator.get_next(datetime)
+
+        if intervals and intervals[-1][1] == firing:
+            intervals[-1][1] = firing + FIRING_LENGTH
+        else:
+            intervals.append([firing, firing + FIRING_LENGTH])
+
+        if firing >= end:
+            return [tuple(interval) for interval in intervals]
+
+
+launch_window_schedule = LaunchWindowSchedule()
@@ -0,0 +1,60 @@
+from datetime import datetime, timedelta
+
+from django.test import TestCase
+
+from model_mommy import mommy
+
+from fabric_bolt.launch_window.models import LaunchWindow
+from fabric_bolt.launch_window.schedule import LaunchWindowSchedule
+
+
+class LaunchWindowScheduleTests(TestCase):
+
+    def setUp(self):
+        self.schedule = LaunchWindowSchedule()
+
+    def test_no_windows(self):
+        self.assertEqual(self.schedule.get_status(), (False, False, None))
+
+    def test_open_window(self):
+        mommy.make(LaunchWindow, cron_format='* 09-17 * * 1-4')  # 9AM-6PM Mon-Thurs
+
+        status = self.schedule.get_status(datetime(2014, 6, 2, 12, 30, 30))  # a Monday
+        self.assertEqual(status, (True, True, datetime(2014, 6, 2, 12, 30, 30)))
+
+        # Open during all of the last minute too
+        self.assertTrue(self.schedule.get_status(datetime(2014, 6, 2, 17, 59, 59)).is_open)
+
+    def test_next_window(self):
+        mommy.make(LaunchWindow, cron_format='* 09-17 * * 1-4')
+
+        # Friday evening, the next window is on Monday. That's days away, not seconds.
+        status = self.schedule.get_status(datetime(2014, 6, 6, 18, 0, 30))
+        self.assertEqual(status, (True, False, datetime(2014, 6, 9, 9, 0)))
+
+    def test_windows_change(self):
+        window = mommy.make(LaunchWindow, cron_format='0 3 * * *')
+        now = datetime(2014, 6, 2, 12, 0)
+
+        self.assertEqual(self.schedule.get_status(now).next_open, datetime(2014, 6, 3, 3, 0))
+
+        with self.assertNumQueries(1):
+            self.schedule.get_status(now + timedelta(minutes=1))
+
+        window.cron_format = '0 13 * * *'
+        window.save()
+        invalid = mommy.make(LaunchWindow, cron_format='not cron')
+
+        self.assertEqual(self.schedule.get_status(now).next_open, datetime(2014, 6, 2, 13, 0))
+
+        window.delete()
+        self.assertEqual(self.schedule.get_status(now), (True, False, None))
+
+        invalid.delete()
+        self.assertEqual(self.schedule.get_status(now), (False, False, None))
+
+    def test_refresh(self):
+        mommy.make(LaunchWindow, cron_format='0 3 * * *')
+
+        self.assertFalse(self.schedule.get_status(datetime(2014, 6, 2, 12, 0)).is_open)
+        self.assertTrue(self.schedule.get_status(datetime(2014, 6, 10, 3, 0)).is_open)
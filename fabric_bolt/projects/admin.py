@@ -1,6 +1,7 @@
 from django.contrib import admin
 
 from fabric_bolt.projects import models
+from fabric_bolt.projects.util import record_deployment_stats, forget_deployment_stats
 
 
 class ConfigurationModelAdmin(admin.ModelAdmin):
@@ -10,6 +11,17 @@ class ConfigurationModelAdmin(admin.ModelAdmin):
 class DeploymentModelAdmin(admin.ModelAdmin):
     list_display = ['stage', 'status', 'date_created', 'task']
 
+    def save_model(self, request, obj, form, change):
+        super(DeploymentModelAdmin, self).save_model(request, obj, form, change)
+
+        # The only place deployments get soft-deleted or restored: take them out of the deployment stats, or back in
+        was_deleted = form.initial.get('date_deleted') is not None
+        if change and (obj.date_deleted is not None) != was_deleted:
+            if was_deleted:
+                record_deployment_stats(obj)
+            else:
+                forget_deployment_stats(obj, status=form.initial.get('status'))
+
 
 admin.site.register(models.Project)
 admin.site.register(models.Configuration, ConfigurationModelAdmin)
@@ -0,0 +1,223 @@
+"""
+Runs queued deployments in a pool of worker processes, outside of the web and socket.io servers.
+
+With DEPLOYMENT_QUEUE_ENABLED, views only queue deployments and follow their output from the database. The pool is
+started with `manage.py run_deployment_workers`.
+"""
+
+import os
+import time
+import signal
+import logging
+import subprocess
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from fabric_bolt.projects.models import Deployment
+from fabric_bolt.projects.util import file_lock, start_deployment_process, read_process_output, \
+    DeploymentLogWriter, finish_deployment
+
+logger = logging.getLogger(__name__)
+
+# How often (in seconds) the output of a running deployment is logged, and read back by whoever follows it. The worker
+# renews the deployment's heartbeat, and checks whether it has been aborted, just as often.
+OUTPUT_SAVE_INTERVAL = 1
+
+
+def queue_enabled():
+    return getattr(settings, 'DEPLOYMENT_QUEUE_ENABLED', False)
+
+
+def get_heartbeat_timeout():
+    return timedelta(seconds=getattr(settings, 'DEPLOYMENT_HEARTBEAT_TIMEOUT', 60))
+
+
+def fail_abandoned_deployments():
+    """
+    Fail the running deployments whose worker has stopped renewing their heartbeat (it was killed or crashed), so
+    they don't keep their hosts busy forever. Returns them.
+    """
+
+    cutoff = timezone.now() - get_heartbeat_timeout()
+    abandoned = []
+
+    for deployment in Deployment.objects.filter(status=Deployment.RUNNING, heartbeat__lt=cutoff):
+        # Unless its worker came back in the meantime
+        if not Deployment.objects.filter(pk=deployment.pk, status=Deployment.RUNNING, heartbeat__lt=cutoff)\
+                .update(status=Deployment.FAILED, pid=None, secrets=None):
+            continue
+
+        logger.warning('Deployment %s was abandoned by its worker', deployment.pk)
+
+        log = DeploymentLogWriter(deployment)
+        log.write('The worker running this deployment stopped responding, it was marked as failed.\n')
+        log.close()
+
+        deployment.status = Deployment.FAILED
+        deployment.pid = None
+        deployment.secrets = None
+        finish_deployment(deployment)
+
+        abandoned.append(deployment)
+
+    return abandoned
+
+
+def claim_next_deployment(per_host_limit=0):
+    """
+    Mark the oldest queued deployment that fits in the per host limit as running and return it.
+
+    Returns None when there is nothing to run.
+    """
+
+    # Only one worker may pick at a time, otherwise two of them could both take the last free slot of a host
+    with file_lock('deployment_queue'):
+        fail_abandoned_deployments()
+
+        busy_hosts = Counter(
+            host_id for host_id in
+            Deployment.objects.filter(status=Deployment.RUNNING).values_list('stage__hosts', flat=True)
+            if host_id is not None
+        )
+
+        queued = Deployment.objects.filter(status=Deployment.QUEUED)\
+            .order_by('date_created')\
+            .prefetch_related('stage__hosts')
+
+        for deployment in queued:
+            host_ids = [host.pk for host in deployment.stage.hosts.all()]
+
+            if per_host_limit and any(busy_hosts[host_id] >= per_host_limit for host_id in host_ids):
+                continue
+
+            # Somebody may have aborted it in the meantime
+            now = timezone.now()
+            if Deployment.objects.filter(pk=deployment.pk, status=Deployment.QUEUED)\
+                    .update(status=Deployment.RUNNING, heartbeat=now):
+                deployment.status = Deployment.RUNNING
+                deployment.heartbeat = now
+                return deployment
+
+    return None
+
+
+def renew_heartbeat(deployment):
+    """Returns False if the deployment isn't ours to run anymore: it was aborted, or failed as abandoned"""
+
+    return bool(Deployment.objects.filter(pk=deployment.pk, status=Deployment.RUNNING)
+                .update(heartbeat=timezone.now()))
+
+
+def kill_deployment_process(process):
+    """Stop a deployment's command, along with everything it started"""
+
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+
+def run_deployment(deployment):
+    """Run a claimed deployment to completion, appending its output to its log as it goes"""
+
+    log = DeploymentLogWriter(deployment, max_delay=OUTPUT_SAVE_INTERVAL)
+    process = None
+
+    try:
+        # In a process group of its own, so stopping it stops whatever fab started too
+        process = start_deployment_process(deployment, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                           preexec_fn=os.setsid)
+        last_heartbeat = time.time()
+
+        for output in read_process_output(process, timeout=OUTPUT_SAVE_INTERVAL):
+            log.write(output)
+
+            if time.time() - last_heartbeat >= OUTPUT_SAVE_INTERVAL:
+                last_heartbeat = time.time()
+
+                if not renew_heartbeat(deployment):
+                    kill_deployment_process(process)
+
+        returncode = process.returncode
+    except Exception as e:
+        logger.exception('Deployment %s could not be run', deployment.pk)
+        log.write('An error occurred: {}\n'.format(e))
+        returncode = -1
+    except (SystemExit, KeyboardInterrupt):
+        # The worker is being stopped
+        if process is not None:
+            kill_deployment_process(process)
+
+        log.write('The worker running this deployment was stopped.\n')
+        returncode = -1
+        raise
+    finally:
+        log.close()
+
+        # Only the status field is ours to change, it may have been aborted from the web while running. If it was
+        # failed as abandoned, that's been finished already.
+        status = Deployment.objects.filter(pk=deployment.pk).values_list('status', flat=True).first()
+
+        if status in (Deployment.RUNNING, Deployment.ABORTED):
+            if status == Deployment.ABORTED:
+                deployment.status = Deployment.ABORTED
+            else:
+                deployment.status = Deployment.SUCCESS if returncode == 0 else Deployment.FAILED
+
+            deployment.pid = None
+            deployment.secrets = None
+            finish_deployment(deployment)
+
+
+def stop_worker(signum, frame):
+    raise SystemExit()
+
+
+def work(per_host_limit=0, poll_interval=1):
+    """Main loop of a worker process: run queued deployments one at a time, until it's terminated"""
+
+    signal.signal(signal.SIGTERM, stop_worker)
+
+    while True:
+        try:
+            deployment = claim_next_deployment(per_host_limit)
+        except Exception:
+            logger.exception('Could not claim a deployment')
+            deployment = None
+
+        if deployment is None:
+            time.sleep(poll_interval)
+        else:
+            run_deployment(deployment)
+
+
+def follow_deployment_output(deployment, poll_interval=OUTPUT_SAVE_INTERVAL):
+    """
+    Yield the output of a queued or running deployment as its worker logs it, until it has finished.
+
+    deployment.status is kept up to date, so it holds the final status afterwards.
+    """
+
+    sequence = 0
+    sent = 0
+
+    while True:
+        # Read the status first, chunks logged before it changed are then sure to be picked up
+        deployment.status = Deployment.objects.filter(pk=deployment.pk).values_list('status', flat=True).get()
+
+        if deployment.status not in (Deployment.QUEUED, Deployment.RUNNING):
+            break
+
+        for sequence, text in deployment.log_chunks.filter(sequence__gt=sequence).values_list('sequence', 'text'):
+            yield text
+            sent += len(text)
+
+        time.sleep(poll_interval)
+
+    # Once finished, the chunks may have been archived already
+    output = Deployment.objects.get(pk=deployment.pk).output
+    if len(output) > sent:
+        yield output[sent:]
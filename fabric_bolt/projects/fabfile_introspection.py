@@ -0,0 +1,119 @@
+"""
+Standalone helper that loads a fabfile once and prints every task it defines as JSON.
+
+This file is executed with the project's own python (inside its virtualenv), so it must not import Django or
+anything from fabric_bolt. Usage:
+
+    python fabfile_introspection.py /path/to/fabfile.py
+"""
+
+import inspect
+import json
+import sys
+import textwrap
+
+try:
+    string_types = basestring
+except NameError:  # python 3
+    string_types = str
+
+# getargspec is gone from newer pythons, the fabfile's virtualenv may be running one of those
+getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
+
+
+def get_task_callable(task):
+    """Find the function whose signature describes the arguments of a fabric task"""
+
+    if hasattr(task, 'wrapped'):
+        # WrappedCallableTask (@task decorated functions), possibly nested
+        while 'wrapped' in task.__dict__:
+            task = task.__dict__['wrapped']
+        return task
+
+    if hasattr(task, '__details__'):
+        # Task subclasses put their signature on run()
+        return task.run
+
+    return task
+
+
+def get_task_arguments(func):
+    """
+    Mirror what `fab --display` reports: a list of argument names, with string defaults given as (name, default).
+
+    All fab arguments are passed as strings, so non string defaults are meaningless and ignored.
+    """
+
+    argspec = getargspec(func)
+    args = list(argspec.args)
+
+    if inspect.ismethod(func) and func.__self__ is not None and args:
+        args = args[1:]  # drop self
+
+    defaults = list(argspec.defaults or [])
+    num_required = len(args) - len(defaults)
+
+    arguments = list(args[:num_required])
+
+    for name, default in zip(args[num_required:], defaults):
+        if isinstance(default, string_types):
+            arguments.append([name, default])
+        else:
+            arguments.append(name)
+
+    return arguments
+
+
+def get_task_docstring(func, task):
+    docstring = getattr(task, '__doc__', None) or getattr(func, '__doc__', None)
+
+    if not docstring:
+        return None
+
+    return '\n'.join(line.strip() for line in textwrap.dedent(docstring).splitlines()).strip() or None
+
+
+def introspect(fabfile_path):
+    from fabric.main import load_fabfile, _task_names, crawl
+
+    docstring, callables, default = load_fabfile(fabfile_path)
+
+    tasks = []
+    for name in _task_names(callables):
+        task = crawl(name, callables)
+        func = get_task_callable(task)
+
+        try:
+            arguments = get_task_arguments(func)
+        except TypeError:
+            arguments = []
+
+        tasks.append({
+            'name': name,
+            'docstring': get_task_docstring(func, task),
+            'arguments': arguments,
+        })
+
+    return tasks
+
+
+def main(argv):
+    if len(argv) != 2:
+        sys.stderr.write('usage: {} FABFILE\n'.format(argv[0]))
+        return 2
+
+    # Anything the fabfile prints while being imported must not end up in our JSON
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        tasks = introspect(argv[1])
+    finally:
+        sys.stdout = stdout
+
+    json.dump(tasks, stdout)
+    stdout.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
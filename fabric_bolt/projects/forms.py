@@ -19,6 +19,7 @@ class ProjectCreateForm(forms.ModelForm):
             'description',
             'use_repo_fabfile',
             'repo_url',
+            'repo_fabfile_path',
             'task_regex',
             'fabfile_requirements',
         ]
@@ -31,6 +32,7 @@ class ProjectCreateForm(forms.ModelForm):
             'task_regex',
             'use_repo_fabfile',
             'repo_url',
+            'repo_fabfile_path',
             'fabfile_requirements',
             ButtonHolder(
                 Submit('submit', '%s Project' % self.button_prefix, css_class='button')
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from fabric_bolt.projects.models import Deployment
+from fabric_bolt.projects.util import archive_deployment_output
+
+
+class Command(BaseCommand):
+    help = 'Compress the output of finished deployments that is still stored uncompressed, such as the output of ' \
+           'deployments that ran before logs were archived.'
+
+    def handle(self, *args, **options):
+        deployments = Deployment.objects\
+            .exclude(status__in=[Deployment.PENDING, Deployment.QUEUED, Deployment.RUNNING])\
+            .filter(Q(legacy_output__isnull=False) | Q(log_chunks__isnull=False))\
+            .distinct()\
+            .only('pk', 'legacy_output')
+
+        count = size = compressed_size = 0
+
+        for deployment in deployments.iterator():
+            archive = archive_deployment_output(deployment)
+
+            if archive is None:
+                continue
+
+            count += 1
+            size += archive.size
+            compressed_size += archive.compressed_size
+
+        self.stdout.write('Archived {} deployment logs, {} bytes compressed to {} bytes'.format(
+            count, size, compressed_size))
@@ -0,0 +1,57 @@
+import time
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from fabric_bolt.projects.models import Project
+from fabric_bolt.projects.util import get_fabfile_path, load_fabric_tasks, remove_unused_virtual_envs
+
+
+def prewarm_project(project):
+    """Pull the repo, update the virtualenv and cache the tasks of a project. Returns (project, task count or error)"""
+
+    try:
+        get_fabfile_path(project, refresh=True)
+        return project, len(load_fabric_tasks(project))
+    except Exception as e:
+        return project, e
+
+
+class Command(BaseCommand):
+    help = 'Refresh the repo checkouts, virtualenvs and task caches of all active projects so pages never have to. ' \
+           'Virtualenvs no active project needs anymore are removed.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=4,
+                    help='Number of projects to refresh at the same time.'),
+        make_option('--interval', type='int', dest='interval', default=None,
+                    help='Keep running, refreshing every INTERVAL seconds. Use something shorter than '
+                         'FABRIC_TASK_CACHE_TIMEOUT so the cache never goes cold.'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            self.prewarm(options['workers'])
+
+            if not options['interval']:
+                break
+
+            time.sleep(options['interval'])
+
+    def prewarm(self, workers):
+        projects = list(Project.active_records.all())
+        pool = ThreadPool(max(1, workers))
+
+        try:
+            for project, result in pool.imap_unordered(prewarm_project, projects):
+                if isinstance(result, Exception):
+                    self.stderr.write('{}: failed ({})'.format(project, result))
+                else:
+                    self.stdout.write('{}: {} tasks'.format(project, result))
+        finally:
+            pool.close()
+            pool.join()
+
+        for env_dir in remove_unused_virtual_envs(projects):
+            self.stdout.write('Removed unused virtualenv {}'.format(env_dir))
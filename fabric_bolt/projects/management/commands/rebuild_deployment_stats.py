@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from fabric_bolt.projects.util import rebuild_deployment_stats
+
+
+class Command(BaseCommand):
+    help = 'Recount the deployment stats the dashboard and project tables show from all finished deployments. Run ' \
+           'this once after upgrading, and whenever the stats seem off.'
+
+    def handle(self, *args, **options):
+        count = rebuild_deployment_stats()
+
+        self.stdout.write('Counted {} finished deployments'.format(count))
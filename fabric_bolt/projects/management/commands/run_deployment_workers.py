@@ -0,0 +1,63 @@
+import time
+import signal
+from multiprocessing import Process
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from fabric_bolt.projects.executor import work, stop_worker
+
+
+class Command(BaseCommand):
+    help = 'Run queued deployments (see DEPLOYMENT_QUEUE_ENABLED) in a pool of worker processes.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='Number of deployments to run at the same time. Defaults to DEPLOYMENT_WORKERS.'),
+        make_option('--per-host', type='int', dest='per_host', default=None,
+                    help='Number of deployments to run against the same host at the same time, 0 for no limit. '
+                         'Defaults to DEPLOYMENT_WORKERS_PER_HOST.'),
+    )
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or getattr(settings, 'DEPLOYMENT_WORKERS', 4)
+        per_host = options['per_host']
+        if per_host is None:
+            per_host = getattr(settings, 'DEPLOYMENT_WORKERS_PER_HOST', 1)
+
+        processes = []
+
+        # Supervisors stop us with SIGTERM, the workers have to go down with us
+        signal.signal(signal.SIGTERM, stop_worker)
+
+        try:
+            while True:
+                processes = [process for process in processes if process.is_alive()]
+
+                while len(processes) < workers:
+                    processes.append(self.start_worker(per_host))
+
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in processes:
+                process.terminate()
+
+            # Each one stops and finishes the deployment it was running first
+            for process in processes:
+                process.join()
+
+    def start_worker(self, per_host):
+        # Forked children must not share the parent's database connections
+        for connection in connections.all():
+            connection.close()
+
+        process = Process(target=work, args=(per_host,))
+        process.daemon = True
+        process.start()
+
+        self.stdout.write('Started deployment worker {}'.format(process.pid))
+        return process
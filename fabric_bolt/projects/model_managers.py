@@ -1,4 +1,9 @@
-from django.db import models
+from datetime import datetime
+
+from django.db import models, connections
+from django.db.models import Count
+from django.utils import six
+from django.utils.dateparse import parse_date
 
 
 class ActiveManager(models.Manager):
@@ -6,9 +11,48 @@ class ActiveManager(models.Manager):
         return super(ActiveManager, self).get_queryset().filter(date_deleted__isnull=True)
 
 
-class ActiveDeploymentManager(models.Manager):
+class DeploymentQuerySet(models.QuerySet):
+    # The columns DeploymentTable renders, so history pages don't fetch output, commands and the like
+    TABLE_FIELDS = ['date_created', 'status', 'stage', 'stage__name', 'stage__project', 'task', 'task__name']
+
+    def for_table(self):
+        return self.select_related('stage', 'task').only(*self.TABLE_FIELDS)
+
+    def count_by_day(self, *fields):
+        """
+        Count the deployments per day (in UTC, as stored) and fields with a single GROUP BY query.
+
+        Returns a list of dicts holding the fields, 'day' (a date) and 'count'.
+        """
+
+        ops = connections[self.db].ops
+        day_sql = ops.date_trunc_sql('day', '{}.{}'.format(ops.quote_name(self.model._meta.db_table),
+                                                           ops.quote_name('date_created')))
+
+        rows = list(self.order_by().extra(select={'day': day_sql}).values('day', *fields).annotate(count=Count('pk')))
+
+        for row in rows:
+            # Depending on the database this is a date string or a datetime
+            if isinstance(row['day'], six.string_types):
+                row['day'] = parse_date(row['day'][:10])
+            elif isinstance(row['day'], datetime):
+                row['day'] = row['day'].date()
+
+        return rows
+
+
+DeploymentManager = models.Manager.from_queryset(DeploymentQuerySet)
+
+
+class ActiveDeploymentManager(DeploymentManager):
     def get_queryset(self):
         return super(ActiveDeploymentManager, self).get_queryset()\
             .filter(date_deleted__isnull=True,
                     stage__date_deleted__isnull=True,
-                    stage__project__date_deleted__isnull=True)
\ No newline at end of file
+                    stage__project__date_deleted__isnull=True)
+
+
+class ActiveDeploymentStatsManager(models.Manager):
+    def get_queryset(self):
+        return super(ActiveDeploymentStatsManager, self).get_queryset()\
+            .filter(stage__date_deleted__isnull=True, project__date_deleted__isnull=True)
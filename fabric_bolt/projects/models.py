@@ -1,3 +1,5 @@
+import copy
+import zlib
 import operator
 
 from django.core.urlresolvers import reverse
@@ -5,9 +7,11 @@ from django.db.models import Count, Sum
 from django.db import models
 from django.db.models import Q
 from django.conf import settings
+from django.utils.encoding import force_text
 
 from fabric_bolt.core.mixins.models import TrackingFields
-from fabric_bolt.projects.model_managers import ActiveManager, ActiveDeploymentManager
+from fabric_bolt.projects.model_managers import ActiveManager, ActiveDeploymentManager, DeploymentManager, \
+    ActiveDeploymentStatsManager
 
 from re import compile as compile_regex
 
@@ -24,6 +28,9 @@ class Project(TrackingFields):
     repo_url = models.CharField(max_length=200, null=True, blank=True, help_text='Currently only git repos are supported.')
     fabfile_requirements = models.TextField(null=True, blank=True, help_text='Pip requirements to install for fabfile. '
                                                                              'Enter one requirement per line.')
+    repo_fabfile_path = models.CharField(max_length=255, default='fabfile.py', verbose_name='Fabfile path in repo',
+                                         help_text='Only the directory the fabfile is in is checked out, all of '
+                                                   'the repo for a fabfile at its root.')
     task_regex = models.CharField(max_length=1000, null=True, blank=True,
                                   help_text='Regex to select tasks to display for this project')
     # Managers
@@ -31,6 +38,9 @@ class Project(TrackingFields):
     active_records = ActiveManager()
     # End Managers
 
+    class Meta:
+        index_together = [['date_deleted']]
+
     def displayed_tasks(self, all_tasks):
         if not self.task_regex:
             return all_tasks
@@ -68,8 +78,8 @@ class Project(TrackingFields):
     def get_deployment_count(self):
         """Utility function to get the number of deployments a given project has"""
 
-        ret = self.stage_set.annotate(num_deployments=Count('deployment')).aggregate(total_deployments=Sum('num_deployments'))
-        return ret['total_deployments']
+        ret = self.deploymentstats_set.aggregate(total_deployments=Sum('count'))
+        return ret['total_deployments'] or 0
 
 
 class Stage(TrackingFields):
@@ -82,6 +92,9 @@ class Stage(TrackingFields):
     active_records = ActiveManager()
     # End Managers
 
+    class Meta:
+        index_together = [['project', 'date_deleted']]
+
     def __unicode__(self):
         return self.name
 
@@ -101,9 +114,30 @@ class Stage(TrackingFields):
 
         return self.project.web_hooks()
 
+    def get_configuration_candidates(self):
+        """
+        This stage's configurations and its project's, in one query. Stages are loaded for each request, so that's
+        once per request however many times they are resolved. Saving a configuration on this stage instance forgets
+        them.
+        """
+
+        if getattr(self, '_configuration_candidates', None) is None:
+            self._configuration_candidates = list(
+                Configuration.objects.filter(Q(stage=self) | Q(project_id=self.project_id, stage__isnull=True))
+                .order_by('pk')
+            )
+
+        return self._configuration_candidates
+
+    def forget_configurations(self):
+        self._configuration_candidates = None
+
     def get_queryset_configurations(self, **kwargs):
         """
-        Really we just want to do a simple SQL statement like this (but oh the ORM):
+        The configurations used on this stage: its own, then those of its project it doesn't have. Only those whose
+        fields have the values in kwargs are considered, e.g. prompt_me_for_input=False.
+
+        This is the following SQL, resolved in python over get_configuration_candidates:
 
         SELECT Distinct(Coalesce(stage.key, project.key)) AS key,
         (CASE WHEN stage.key IS NOT null THEN stage.data_type ELSE project.data_type END) AS data_type,
@@ -117,46 +151,41 @@ class Stage(TrackingFields):
             AND project.key = stage.key AND stage.stage_id = STAGE_ID_HERE
         WHERE project.project_id = PROJECT_ID_HERE AND (project.stage_id is null OR project.stage_id = STAGE_ID_HERE)
         """
-        queryset_list = []
-        current_configs = []
 
-        # Create stage specific configurations dictionary
-        for stage in self.stage_configurations().filter(**kwargs):
-            queryset_list.append(stage)
-            current_configs.append(stage.key)
+        candidates = [config for config in self.get_configuration_candidates()
+                      if all(getattr(config, field) == value for field, value in kwargs.items())]
 
-        for project in self.project.project_configurations().filter(**kwargs):
-            if not project.key in current_configs:
-                queryset_list.append(project)
-                current_configs.append(project.key)
+        configurations = [config for config in candidates if config.stage_id is not None]
+        keys = set(config.key for config in configurations)
 
-        return queryset_list
+        for config in candidates:
+            if config.stage_id is None and config.key not in keys:
+                configurations.append(config)
+                keys.add(config.key)
+
+        return configurations
 
     def get_configurations(self):
         """
         Generates a dictionary that's made up of the configurations on the project.
         Any configurations on a project that are duplicated on a stage, the stage configuration will take precedence.
-        """
-
-        project_configurations_dictionary = {}
-        project_configurations = self.project.project_configurations()
 
-        # Create project specific configurations dictionary
-        for config in project_configurations:
-            project_configurations_dictionary[config.key] = config
+        The configurations are copies, callers can set their values without it showing up elsewhere.
+        """
 
-        stage_configurations_dictionary = {}
-        stage_configurations = self.stage_configurations()
+        candidates = self.get_configuration_candidates()
 
-        # Create stage specific configurations dictionary
-        for s in stage_configurations:
-            stage_configurations_dictionary[s.key] = s
+        # Project configurations first, so the stage's override them
+        configurations = {}
+        for config in candidates:
+            if config.stage_id is None:
+                configurations[config.key] = copy.copy(config)
 
-        # override project specific configuration with the ones in the stage if they are there
-        project_configurations_dictionary.update(stage_configurations_dictionary)
+        for config in candidates:
+            if config.stage_id is not None:
+                configurations[config.key] = copy.copy(config)
 
-        # Return the updated configurations
-        return project_configurations_dictionary
+        return configurations
 
 
 class Configuration(TrackingFields):
@@ -212,6 +241,20 @@ class Configuration(TrackingFields):
     def __unicode__(self):
         return u'{}: {}'.format(self.key, self.value)
 
+    def save(self, *args, **kwargs):
+        super(Configuration, self).save(*args, **kwargs)
+        self.forget_stage_configurations()
+
+    def delete(self, *args, **kwargs):
+        super(Configuration, self).delete(*args, **kwargs)
+        self.forget_stage_configurations()
+
+    def forget_stage_configurations(self):
+        """The stage instance this configuration was set on resolves its configurations again"""
+
+        if self.stage_id and Configuration.stage.is_cached(self):
+            self.stage.forget_configurations()
+
     def get_absolute_url(self):
         """Determine where I am coming from and where I am going"""
 
@@ -265,6 +308,7 @@ class Deployment(TrackingFields):
     """
 
     PENDING = 'pending'
+    QUEUED  = 'queued'
     RUNNING = 'running'
     FAILED  = 'failed'
     SUCCESS = 'success'
@@ -272,28 +316,44 @@ class Deployment(TrackingFields):
 
     STATUS = [(PENDING, 'Pending'), (FAILED, 'Failed'),
               (SUCCESS, 'Success'), (ABORTED, 'Aborted'),
-              (RUNNING, 'Running')]
+              (RUNNING, 'Running'), (QUEUED, 'Queued')]
 
     user = models.ForeignKey(settings.AUTH_USER_MODEL)
     stage = models.ForeignKey(Stage)
     comments = models.TextField(blank=True)
-    status = models.CharField(choices=STATUS, max_length=10, default=PENDING)
-    output = models.TextField(null=True, blank=True)
+    status = models.CharField(choices=STATUS, max_length=10, default=PENDING, db_index=True)
+    # Output of deployments from before it was stored as DeploymentLogChunks, see output
+    legacy_output = models.TextField(db_column='output', null=True, blank=True)
     task = models.ForeignKey('projects.Task')
     pid = models.CharField(max_length=6, null=True)
+    # Renewed by the worker running a queued deployment, deployments whose worker stopped renewing it are failed
+    heartbeat = models.DateTimeField(null=True, blank=True)
     configuration = models.TextField(null=True, blank=True)
 
+    # Resolved when the deployment is created, so running it is only a matter of spawning the command
+    command = models.TextField(null=True, blank=True)
+    fabfile_path = models.CharField(max_length=255, null=True, blank=True)
+    # Repo fabfiles only run at this commit, see start_deployment_process
+    fabfile_commit = models.CharField(max_length=40, null=True, blank=True)
+    virtualenv = models.CharField(max_length=255, null=True, blank=True)
+    # Sensitive values the command refers to, forgotten as soon as it's started, aborted or finished
+    secrets = models.TextField(null=True, blank=True)
+
     # Managers
-    objects = models.Manager()
+    objects = DeploymentManager()
     active_records = ActiveDeploymentManager()
     # End Managers
 
     class Meta:
         ordering = ['-date_created']
+        # History pages list a stage's deployments newest first, active_records filters on date_deleted
+        index_together = [['stage', 'date_created'], ['date_deleted']]
+
+    FINISHED_STATUSES = [SUCCESS, FAILED, ABORTED]
 
     @property
     def in_progress(self):
-        return self.status in [self.PENDING, self.RUNNING]
+        return self.status in [self.PENDING, self.QUEUED, self.RUNNING]
 
     def __unicode__(self):
         return u'Deployment at {} status: {}'.format(self.date_created, self.get_status_display())
@@ -304,6 +364,84 @@ class Deployment(TrackingFields):
 
         return self.stage.web_hooks
 
+    @property
+    def output(self):
+        """The whole output, assembled from the log chunks the first time it's needed"""
+
+        if not hasattr(self, '_output'):
+            parts = [self.legacy_output or '']
+
+            if self.pk:
+                try:
+                    parts.append(self.log_archive.text)
+                except DeploymentLogArchive.DoesNotExist:
+                    pass
+
+                parts.extend(self.log_chunks.values_list('text', flat=True))
+
+            self._output = ''.join(parts)
+
+        return self._output
+
+    @output.setter
+    def output(self, value):
+        self.legacy_output = value
+        self.__dict__.pop('_output', None)
+
+
+class DeploymentLogChunk(models.Model):
+    """A piece of the output of a deployment. Chunks are only ever appended, never rewritten."""
+
+    deployment = models.ForeignKey(Deployment, related_name='log_chunks')
+    sequence = models.PositiveIntegerField()
+    text = models.TextField()
+
+    class Meta:
+        ordering = ['sequence']
+        unique_together = [('deployment', 'sequence')]
+
+
+class DeploymentLogArchive(models.Model):
+    """The zlib compressed output of a finished deployment, kept out of the deployments table"""
+
+    deployment = models.OneToOneField(Deployment, related_name='log_archive')
+    data = models.BinaryField()
+    size = models.PositiveIntegerField(help_text='Uncompressed size in bytes')
+    compressed_size = models.PositiveIntegerField()
+
+    @property
+    def ratio(self):
+        return float(self.size) / self.compressed_size if self.compressed_size else 1.0
+
+    @property
+    def text(self):
+        return force_text(zlib.decompress(bytes(self.data)))
+
+
+class DeploymentStats(models.Model):
+    """Number of finished deployments per stage, day and status
+
+    Kept up to date when deployments finish, are deleted or are soft-deleted in the admin, rebuild it with the
+    rebuild_deployment_stats management command. Soft-deleted stages and projects keep their counts, active_records leaves them out."""
+
+    project = models.ForeignKey(Project)
+    stage = models.ForeignKey(Stage)
+    day = models.DateField(help_text='UTC date the deployments were created')
+    status = models.CharField(choices=Deployment.STATUS, max_length=10)
+    count = models.PositiveIntegerField(default=0)
+
+    # Managers
+    objects = models.Manager()
+    active_records = ActiveDeploymentStatsManager()
+    # End Managers
+
+    class Meta:
+        unique_together = [('stage', 'day', 'status')]
+        index_together = [['project', 'day']]
+
+    def __unicode__(self):
+        return u'{} deployments {} on {}'.format(self.count, self.status, self.day)
+
 
 class Task(models.Model):
     name = models.CharField(max_length=255)
@@ -0,0 +1,25 @@
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from fabric_bolt.projects.signals import deployment_finished
+from fabric_bolt.projects.models import Deployment
+from fabric_bolt.projects.util import record_deployment_stats, forget_deployment_stats
+
+
+@receiver(deployment_finished)
+def deployment_stats_receiver(sender, **kwargs):
+    """Count the finished deployment in the deployment stats"""
+
+    deployment = Deployment.objects.select_related('stage').only('date_created', 'date_deleted', 'status', 'stage',
+                                                                'stage__project').get(pk=kwargs.get('deployment_id'))
+
+    # Counted once the status is committed, failing can't roll that back
+    return lambda: record_deployment_stats(deployment)
+
+
+@receiver(post_delete, sender=Deployment)
+def deployment_deleted_receiver(sender, instance, **kwargs):
+    """Take deleted deployments out of the deployment stats, unless soft-deleting them did already (see admin)"""
+
+    if instance.date_deleted is None:
+        forget_deployment_stats(instance)
@@ -1,3 +1,6 @@
 import django.dispatch
 
+# Sent by finish_deployment in the same transaction that saves the deployment's final status, so whatever receivers
+# write is committed together with it. Receivers should write in a savepoint (transaction.atomic()), so failing
+# doesn't break that transaction, and can return a callable to have it called once that's committed.
 deployment_finished = django.dispatch.Signal(providing_args=["deployment_id", ])
@@ -1,9 +1,6 @@
 import subprocess
 import logging
 import signal
-import fcntl
-import time
-import sys
 import os
 
 from fabric_bolt.projects.models import Deployment
@@ -14,7 +11,8 @@ from socketio.mixins import RoomsMixin, BroadcastMixin
 
 from threading import Thread
 
-from .util import build_command
+from .util import start_deployment_process, read_process_output, DeploymentLogWriter, finish_deployment
+from .executor import queue_enabled, follow_deployment_output
 
 
 @namespace('/deployment')
@@ -29,7 +27,12 @@ class DeployNamespace(BaseNamespace, RoomsMixin, BroadcastMixin):
 
     def on_join(self, deployment_id):
         self.deployment = Deployment.objects.get(pk=deployment_id)
-        if self.deployment.status == self.deployment.PENDING:
+        if queue_enabled():
+            # A worker runs it, we only follow its output
+            if self.deployment.in_progress:
+                self.update_thread = Thread(target=self.follow_output)
+                self.update_thread.start()
+        elif self.deployment.status == self.deployment.PENDING:
             self.update_thread = Thread(target=self.output_stream_generator, args=(self,))
             # self.update_thread.daemon = True
             self.deployment.status = self.deployment.RUNNING
@@ -55,66 +58,59 @@ class DeployNamespace(BaseNamespace, RoomsMixin, BroadcastMixin):
 
     def kill_process(self):
         try:
-            print "Deployment pid is {}".format(self.deployment.pid)
-            os.kill(int(self.deployment.pid), signal.SIGTERM)
+            if queue_enabled():
+                # The worker running it may be on another machine, it stops the deployment once it sees it's aborted.
+                # Queued ones are just never picked up.
+                aborted = Deployment.objects\
+                    .filter(pk=self.deployment.pk, status__in=[Deployment.QUEUED, Deployment.RUNNING])\
+                    .update(status=Deployment.ABORTED, secrets=None)
+
+                if not aborted:
+                    return False
+
+                self.deployment.status = self.deployment.ABORTED
+            else:
+                print "Deployment pid is {}".format(self.deployment.pid)
+                os.kill(int(self.deployment.pid), signal.SIGTERM)
+
+                self.deployment.pid = None
+                self.deployment.status = self.deployment.ABORTED
+                self.deployment.save()
 
             self.broadcast_event('output', {'status': 'running', 'lines': '!!! Aborting... !!!'})
             self.broadcast_event('output', {'status': 'aborted'})
-
-            self.deployment.pid = None
-            self.deployment.status = self.deployment.ABORTED
-            self.deployment.save()
             return True
         except Exception as e:
             print("Failed to kill... {}".format(e))
             return False
 
-    def output_stream_generator(self, *args, **kwargs):
-        cmd = build_command(self.deployment, self.request.session, False),
+    def follow_output(self):
+        for output in follow_deployment_output(self.deployment):
+            self.emit('output', {'status': 'running', 'lines': output})
+
+        self.emit('output', {'status': self.deployment.status})
 
-        self.process = subprocess.Popen(
-            cmd,
+    def output_stream_generator(self, *args, **kwargs):
+        self.process = start_deployment_process(
+            self.deployment,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            stdin=subprocess.PIPE,
-            shell=True
+            stdin=subprocess.PIPE
         )
 
-        self.deployment.pid = self.process.pid
-        self.deployment.save()
-
-        fd = self.process.stdout.fileno()
-        fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-        fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-
-        self.all_output = ''
-        line_count = 0
-        while True:
-            try:
-                nextline = self.process.stdout.read()
-            except IOError:
-                nextline = ''
-
-            if nextline == '' and self.process.poll() != None:
-                break
-
-            self.all_output += nextline
-            line_count += 1
+        log = DeploymentLogWriter(self.deployment)
+        for nextline in read_process_output(self.process):
+            log.write(nextline)
 
             if nextline:
                 self.broadcast_event('output', {'status': 'running', 'lines': str(nextline)})
-                if line_count > 10:
-                    self.deployment.output = self.all_output
-                    self.deployment.save()
-            time.sleep(0.00001)
 
-            sys.stdout.flush()
+        log.close()
 
         if self.deployment.status != self.deployment.ABORTED:
             self.deployment.status = self.deployment.SUCCESS if self.process.returncode == 0 else self.deployment.FAILED
 
-        self.deployment.output = self.all_output
         self.deployment.pid = None
-        self.deployment.save()
+        finish_deployment(self.deployment)
 
         self.broadcast_event('output', {'status': self.deployment.status})
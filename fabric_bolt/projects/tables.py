@@ -22,7 +22,8 @@ class ProjectTable(PaginateTable):
     ], delimiter='&#160;&#160;&#160;')
 
     name = tables.LinkColumn('projects_project_view', kwargs={'pk': tables.A('pk')})
-    deployments = tables.Column(accessor='get_deployment_count', verbose_name='# Deployments', orderable=False)
+    deployments = tables.Column(accessor='deployment_count', verbose_name='# Deployments', order_by='deployment_count',
+                                default=0)
 
     class Meta:
         model = models.Project
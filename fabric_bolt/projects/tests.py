@@ -4,18 +4,59 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import os
+import json
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import subprocess
+import threading
+from datetime import timedelta
+from unittest import skipUnless
+from contextlib import contextmanager
+
+import mock
+
+from django.conf import settings
+from django.contrib import admin
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.contrib.auth import get_user_model
 from django.core.cache import cache
+from django.test.utils import override_settings
+from django.core.management import call_command
+from django.utils.six import StringIO
+from django.db import connection
+from django.db.models import Max
+from django.db.models.signals import post_save, post_delete
+from django.contrib.sessions.models import Session
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
 
 from model_mommy import mommy
 
-from fabric_bolt.projects import models
-from fabric_bolt.projects.util import get_fabfile_path, build_command, parse_task_details
+from fabric_bolt.hosts.models import Host
+from fabric_bolt.launch_window.models import LaunchWindow
+from fabric_bolt.core.context_processors import sidebar_lists
+from fabric_bolt.core.receivers import invalidate_sidebar_lists
+from fabric_bolt.core.mixins.tables import encode_cursor
+from fabric_bolt.projects import models, tables, views
+from fabric_bolt.projects.executor import claim_next_deployment, run_deployment, follow_deployment_output, \
+    renew_heartbeat
+from fabric_bolt.projects.util import get_fabfile_path, build_command, parse_task_details, get_fabric_tasks, \
+    parse_introspection_output, get_fabfile_digest, get_requirements_digest, remove_unused_virtual_envs, \
+    update_project_git, file_lock, freeze_deployment, start_deployment_process, read_process_output, \
+    DeploymentLogWriter, archive_deployment_output, record_deployment_stats, rebuild_deployment_stats, \
+    finish_deployment, VIRTUAL_ENV_READY_MARKER
 
 User = get_user_model()
 
+# Set to seed benchmark sized histories and check how long pages take, which depends too much on the machine to
+# check by default
+BENCHMARKS = bool(os.environ.get('FABRIC_BOLT_BENCHMARKS'))
+
 
 class BasicTests(TestCase):
 
@@ -100,6 +141,22 @@ class BasicTests(TestCase):
         result = c.get(reverse('projects_project_delete', args=(self.project.pk,)))
         self.assertIn(result.status_code, [200, 302])
 
+    def test_project_list_queries(self):
+        url = reverse('projects_project_list') + '?per_page=100'
+        mommy.make(models.DeploymentStats, project=self.project, stage=self.stage, count=3)
+
+        result = self.client.get(url)
+        self.assertContains(result, '<td class="deployments">3</td>', html=True)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+
+        for project in mommy.make(models.Project, _quantity=50):
+            mommy.make(models.DeploymentStats, project=project, stage=mommy.make(models.Stage, project=project))
+
+        with self.assertNumQueries(len(queries)):
+            self.client.get(url)
+
     def test_project_configuration_urls(self):
         """
         Tests that all views return status code of 200
@@ -131,6 +188,81 @@ class BasicTests(TestCase):
         # result = c.get(reverse('projects_deployment_output', args=(self.deployment.pk,)))
         # self.assertIn(result.status_code, [200, 302])
 
+    def test_deployment_detail_output(self):
+        url = reverse('projects_deployment_detail', args=(self.project.pk, self.stage.pk, self.deployment.pk,))
+        output_url = reverse('projects_deployment_output', args=(self.project.pk, self.stage.pk, self.deployment.pk,))
+
+        # Pending deployments are run by the output iframe
+        self.assertContains(self.client.get(url), output_url)
+
+        # Without the queue, nothing serves a running one's output
+        models.Deployment.objects.filter(pk=self.deployment.pk).update(status=models.Deployment.RUNNING)
+        self.assertNotContains(self.client.get(url), output_url)
+        self.assertContains(self.client.get(url), 'var deployment_in_progress = false;')
+
+        # socket.io joins a running one's room whether it streams or not
+        with mock.patch.object(views.DeploymentDetail, 'get_template_names',
+                               return_value=['projects/deployment_detail_socketio.html']):
+            result = self.client.get(url)
+
+        self.assertContains(result, 'var deployment_in_progress = true;')
+        self.assertContains(result, 'id="deployment_abort"')
+
+    def test_deployment_create_freezes_command(self):
+        result = self.client.post(
+            reverse('projects_deployment_create', args=(self.project.pk, self.stage.pk, 'test_env')),
+            {'comments': 'COMMENTS', 'configuration_value_for_KEY': 'PROMPTED',
+             'configuration_value_for_argument': 'ARGUMENT'}
+        )
+        self.assertEqual(result.status_code, 302)
+
+        deployment = models.Deployment.objects.exclude(pk=self.deployment.pk).get()
+        fabfile_path, active_loc = get_fabfile_path(self.project)
+
+        self.assertEqual(
+            deployment.command,
+            'fab test_env:argument="ARGUMENT" --set "KEY=PROMPTED" --abort-on-prompts --fabfile={}'.format(fabfile_path)
+        )
+        self.assertEqual(deployment.fabfile_path, fabfile_path)
+
+    def test_deployment_create_unknown_task(self):
+        # The task list dropped out of the cache after the form was shown
+        with mock.patch('fabric_bolt.projects.util.get_task_details', return_value=None):
+            result = self.client.post(
+                reverse('projects_deployment_create', args=(self.project.pk, self.stage.pk, 'test_env')),
+                {'comments': 'COMMENTS', 'configuration_value_for_KEY': 'PROMPTED',
+                 'configuration_value_for_argument': 'ARGUMENT'}
+            )
+
+        self.assertRedirects(result, reverse('projects_stage_view', args=(self.project.pk, self.stage.pk)),
+                             fetch_redirect_response=False)
+        self.assertFalse(models.Deployment.objects.exclude(pk=self.deployment.pk).exists())
+
+    def test_deployment_create_queues(self):
+        with self.settings(DEPLOYMENT_QUEUE_ENABLED=True):
+            result = self.client.post(
+                reverse('projects_deployment_create', args=(self.project.pk, self.stage.pk, 'test_env')),
+                {'comments': 'COMMENTS', 'configuration_value_for_KEY': 'PROMPTED',
+                 'configuration_value_for_argument': 'ARGUMENT'}
+            )
+        self.assertEqual(result.status_code, 302)
+
+        deployment = models.Deployment.objects.exclude(pk=self.deployment.pk).get()
+        self.assertEqual(deployment.status, models.Deployment.QUEUED)
+        self.assertTrue(deployment.in_progress)
+
+    def test_deployment_create_launch_window(self):
+        mommy.make(LaunchWindow, cron_format='0 0 1 1 *')  # New year's midnight only
+        url = reverse('projects_deployment_create', args=(self.project.pk, self.stage.pk, 'test_env'))
+
+        with self.settings(LAUNCH_WINDOWS_REQUIRED=True):
+            result = self.client.post(url, {'comments': 'COMMENTS', 'configuration_value_for_KEY': 'PROMPTED',
+                                            'configuration_value_for_argument': 'ARGUMENT'})
+
+        self.assertRedirects(result, reverse('projects_stage_view', args=(self.project.pk, self.stage.pk)),
+                             fetch_redirect_response=False)
+        self.assertFalse(models.Deployment.objects.exclude(pk=self.deployment.pk).exists())
+
     def test_project_stage_urls(self):
         """
         Tests that all views return status code of 200
@@ -192,6 +324,32 @@ class BasicTests(TestCase):
         self.assertEqual(configurations['number3'].get_value(), '4')
         self.assertEqual(configurations['number4'].get_value(), '3')
 
+    def test_stage_configuration_queries(self):
+        mommy.make(models.Configuration, project=self.project, key='shared', value='project')
+        mommy.make(models.Configuration, project=self.project, key='prompted', prompt_me_for_input=True)
+        mommy.make(models.Configuration, project=self.project, stage=self.stage, key='shared', value='stage')
+        mommy.make(models.Configuration, project=self.project, stage=mommy.make(models.Stage, project=self.project),
+                   key='other_stage')
+
+        stage = models.Stage.objects.get(pk=self.stage.pk)
+
+        with self.assertNumQueries(1):
+            configurations = stage.get_configurations()
+            listed = stage.get_queryset_configurations()
+            not_prompted = stage.get_queryset_configurations(prompt_me_for_input=False)
+
+        expected = dict((key, config.get_value()) for key, config in self.stage.get_configurations().items())
+        self.assertEqual(expected['shared'], 'stage')
+        self.assertNotIn('other_stage', expected)
+
+        self.assertEqual(dict((key, config.get_value()) for key, config in configurations.items()), expected)
+        self.assertEqual(dict((config.key, config.get_value()) for config in listed), expected)
+        self.assertNotIn('prompted', [config.key for config in not_prompted])
+
+        # Callers get copies to set values on
+        configurations['shared'].set_value('changed')
+        self.assertEqual(stage.get_configurations()['shared'].get_value(), 'stage')
+
 
 class UtilTests(TestCase):
     def test_build_command_injection(self):
@@ -275,6 +433,86 @@ class UtilTests(TestCase):
             '--abort-on-prompts --fabfile={}'.format(fabfile_path)
         )
 
+    def test_freeze_deployment(self):
+        deployment = mommy.make(models.Deployment, task__name='test_env')
+
+        configuration = mommy.make(models.Configuration, key='password', value='', sensitive_value=True,
+                                   prompt_me_for_input=True)
+        deployment.stage.configuration_set.add(configuration)
+
+        freeze_deployment(deployment, {'password': 'p4ss, word'})
+        fabfile_path, active_loc = get_fabfile_path(deployment.stage.project)
+
+        # The prompted password is passed in the environment, not stored in the command
+        self.assertEqual(
+            deployment.command,
+            'fab test_env --password=${FABRIC_BOLT_SECRET_0} --abort-on-prompts --fabfile=' + fabfile_path
+        )
+        self.assertEqual(deployment.fabfile_path, fabfile_path)
+        self.assertIsNone(deployment.fabfile_commit)
+        self.assertIsNone(deployment.virtualenv)
+        self.assertEqual(json.loads(deployment.secrets), {'FABRIC_BOLT_SECRET_0': 'p4ss\\, word'})
+
+    def test_start_deployment_process_fabfile_commit(self):
+        deployment = mommy.make(models.Deployment, command='echo deployed', fabfile_path='/repo/fabfile.py',
+                                fabfile_commit='a' * 40, stage__project__use_repo_fabfile=True)
+
+        # The checkout moved on while the deployment was queued
+        with mock.patch('fabric_bolt.projects.util.get_fabfile_commit', return_value='b' * 40), \
+                mock.patch('fabric_bolt.projects.util.subprocess.Popen') as popen:
+            self.assertRaises(RuntimeError, start_deployment_process, deployment)
+
+        self.assertFalse(popen.called)
+
+        with mock.patch('fabric_bolt.projects.util.get_fabfile_commit', return_value='a' * 40) as get_fabfile_commit:
+            process = start_deployment_process(deployment, stdout=subprocess.PIPE)
+
+        self.assertEqual(process.communicate()[0], 'deployed\n')
+        get_fabfile_commit.assert_called_with(deployment.stage.project, '/repo/fabfile.py')
+
+    def test_freeze_deployment_secrets(self):
+        deployment = mommy.make(models.Deployment, task__name='test_env')
+
+        deployment.stage.configuration_set.add(
+            mommy.make(models.Configuration, key='password', value='', sensitive_value=True, prompt_me_for_input=True),
+            mommy.make(models.Configuration, key='token', value='st0red,t=ken', sensitive_value=True)
+        )
+
+        freeze_deployment(deployment, {'password': 'pa"ss'})
+
+        # Stored sensitive values aren't kept in the command either
+        self.assertNotIn('pa"ss', deployment.command)
+        self.assertNotIn('st0red', deployment.command)
+        self.assertEqual(sorted(json.loads(deployment.secrets).values()), ['pa"ss', 'st0red\\,t\\=ken'])
+
+        # What fab gets once the shell has expanded them
+        deployment.command = deployment.command.replace('fab test_env', 'echo', 1)
+        process = start_deployment_process(deployment, stdout=subprocess.PIPE)
+        output, _ = process.communicate()
+
+        self.assertIn('--password=pa"ss', output)
+        self.assertIn('--set token=st0red\\,t\\=ken', output)
+
+        # Deployments that never start forget them once they're finished
+        queued = mommy.make(models.Deployment, status=models.Deployment.QUEUED, secrets=json.dumps({'A': 'secret'}))
+        queued.status = models.Deployment.FAILED
+        finish_deployment(queued)
+
+        self.assertIsNone(models.Deployment.objects.get(pk=queued.pk).secrets)
+
+    def test_start_deployment_process(self):
+        deployment = mommy.make(models.Deployment, command='echo "$FABRIC_BOLT_SECRET_0"',
+                                secrets=json.dumps({'FABRIC_BOLT_SECRET_0': 'secret'}))
+
+        process = start_deployment_process(deployment, stdout=subprocess.PIPE)
+        output, _ = process.communicate()
+
+        self.assertEqual(output, 'secret\n')
+
+        deployment = models.Deployment.objects.get(pk=deployment.pk)
+        self.assertIsNone(deployment.secrets)
+        self.assertEqual(deployment.pid, str(process.pid))
+
     def test_parse_task_details(self):
         output = """Displaying detailed information for task 'test_env':
 
@@ -356,4 +594,752 @@ class UtilTests(TestCase):
         self.assertEqual(details[1], "Pulls code, updates pip, syncs, migrates, collects static, resets permissions and reloads supervisor and nginx\n:param hard:\n:return:")
         self.assertEqual(len(details[2]), 1)
         self.assertIsInstance(details[2][0], str)
-        self.assertEqual(details[2][0], 'hard')
\ No newline at end of file
+        self.assertEqual(details[2][0], 'hard')
+
+    def test_parse_introspection_output(self):
+        output = '[{"name": "deploy", "docstring": "Deploy it", "arguments": ["hard", ["branch", "master"]]}, ' \
+                 '{"name": "s", "docstring": null, "arguments": []}]'
+
+        tasks = parse_introspection_output(output)
+
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(tasks[0], ('deploy', 'Deploy it', ['hard', ('branch', 'master')]))
+        self.assertIsInstance(tasks[0][2][1], tuple)
+        self.assertEqual(tasks[1], ('s', None, []))
+
+    def test_get_fabric_tasks(self):
+        project = mommy.make(models.Project, use_repo_fabfile=False)
+
+        tasks = dict((task[0], task) for task in get_fabric_tasks(project))
+
+        self.assertIn('update', tasks)
+        self.assertEqual(tasks['update'][1], 'Requires code_root env variable. Does a git pull and restarts the web server')
+        self.assertEqual(tasks['do_nothing'][1], None)
+        self.assertListEqual(tasks['test_env'][2], [('argument', 'nothing')])
+
+    def test_get_fabric_tasks_interpreter(self):
+        project = mommy.make(models.Project, use_repo_fabfile=False)
+
+        # Without a virtualenv the fabfile is loaded by FABRIC_PYTHON, not whatever runs the web server
+        with mock.patch('fabric_bolt.projects.util.subprocess.check_output', return_value='[]') as check_output:
+            get_fabric_tasks(project)
+
+        self.assertEqual(check_output.call_args[0][0][0], 'python')
+
+        with self.settings(FABRIC_PYTHON=sys.executable):
+            self.assertIn('update', [task[0] for task in get_fabric_tasks(project)])
+
+        with self.settings(FABRIC_PYTHON='/nonexistent/python'):
+            self.assertEqual(get_fabric_tasks(project), [])
+
+    def test_get_fabric_tasks_cached_only(self):
+        project = mommy.make(models.Project, use_repo_fabfile=False)
+        repo_project = mommy.make(models.Project, use_repo_fabfile=True)
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+        with override_settings(CACHES=locmem):
+            # Nothing is loaded when nothing was cached
+            with mock.patch('fabric_bolt.projects.util.subprocess.check_output') as check_output:
+                self.assertEqual(get_fabric_tasks(project, cached_only=True), [])
+                self.assertEqual(get_fabric_tasks(repo_project, cached_only=True), [])
+                self.assertFalse(check_output.called)
+
+            tasks = get_fabric_tasks(project)
+
+            with override_settings(FABRIC_TASKS_PREWARMED=True):
+                self.assertEqual(get_fabric_tasks(project), tasks)
+
+    def test_fabfile_digest(self):
+        project = mommy.make(models.Project, use_repo_fabfile=False, fabfile_requirements='requests\nfabric\n')
+        fabfile_path, active_loc = get_fabfile_path(project)
+
+        digest = get_fabfile_digest(project, fabfile_path)
+
+        # Requirement order and blank lines don't matter
+        project.fabfile_requirements = '\nfabric\nrequests'
+        self.assertEqual(get_fabfile_digest(project, fabfile_path), digest)
+
+        project.fabfile_requirements = 'fabric'
+        self.assertNotEqual(get_fabfile_digest(project, fabfile_path), digest)
+
+    def test_prewarm_fabfiles_command(self):
+        project = mommy.make(models.Project, name='PREWARMED', use_repo_fabfile=False)
+        out = StringIO()
+
+        call_command('prewarm_fabfiles', workers=2, stdout=out)
+
+        self.assertIn('PREWARMED: {} tasks'.format(len(get_fabric_tasks(project))), out.getvalue())
+
+    def test_prewarm_fabfiles_command_failure(self):
+        mommy.make(models.Project, name='BROKEN', use_repo_fabfile=False)
+        out = StringIO()
+        err = StringIO()
+
+        with mock.patch('fabric_bolt.projects.util.subprocess.check_output', side_effect=OSError('no python')):
+            call_command('prewarm_fabfiles', workers=1, stdout=out, stderr=err)
+
+        self.assertIn('BROKEN: failed (no python)', err.getvalue())
+        self.assertNotIn('BROKEN', out.getvalue())
+
+    def test_remove_unused_virtual_envs(self):
+        public_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, public_dir)
+
+        project = mommy.make(models.Project, use_repo_fabfile=True, fabfile_requirements='fabric\nrequests')
+        other_project = mommy.make(models.Project, use_repo_fabfile=True, fabfile_requirements='requests\nfabric')
+
+        used = get_requirements_digest(project.fabfile_requirements)
+        self.assertEqual(used, get_requirements_digest(other_project.fabfile_requirements))
+
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+        deleted_project = mommy.make(models.Project, use_repo_fabfile=True, date_deleted=timezone.now())
+        envs_dir = os.path.join(public_dir, '.virtualenvs')
+
+        with override_settings(PUBLIC_DIR=public_dir, CACHES=locmem):
+            for name in (used, 'unused', 'cached', 'queued', 'fresh', 'stale', 'late'):
+                os.makedirs(os.path.join(envs_dir, name))
+
+            # Still used until the cached path expires, or the deployment has run
+            cache.set('project_{}_fabfile_path'.format(project.pk),
+                      ('fabfile.py', os.path.join(envs_dir, 'cached', 'bin', 'activate')))
+            mommy.make(models.Deployment, status=models.Deployment.QUEUED,
+                       virtualenv=os.path.join(envs_dir, 'queued', 'bin', 'activate'))
+
+            # Or until a while after setup_virtual_env_if_needed last handed it out
+            for name in ('fresh', 'stale'):
+                open(os.path.join(envs_dir, name, VIRTUAL_ENV_READY_MARKER), 'w').close()
+            old = time.time() - settings.FABRIC_TASK_CACHE_TIMEOUT - 60
+            os.utime(os.path.join(envs_dir, 'stale', VIRTUAL_ENV_READY_MARKER), (old, old))
+
+            # Paths of projects that aren't swept can't point into removed virtualenvs anymore
+            cache.set('project_{}_fabfile_path'.format(deleted_project.pk),
+                      ('fabfile.py', os.path.join(envs_dir, 'unused', 'bin', 'activate')))
+
+            # Handed out while the sweep was deciding
+            real_file_lock = file_lock
+
+            @contextmanager
+            def late_file_lock(name):
+                with real_file_lock(name):
+                    if name == 'virtualenv_late':
+                        cache.set('project_{}_fabfile_path'.format(other_project.pk),
+                                  ('fabfile.py', os.path.join(envs_dir, 'late', 'bin', 'activate')))
+                    yield
+
+            with mock.patch('fabric_bolt.projects.util.file_lock', late_file_lock):
+                removed = remove_unused_virtual_envs([project, other_project])
+
+            self.assertIsNone(cache.get('project_{}_fabfile_path'.format(deleted_project.pk)))
+            cache.clear()
+
+        self.assertEqual(sorted(removed), [os.path.join(envs_dir, 'stale'), os.path.join(envs_dir, 'unused')])
+        self.assertEqual(sorted(os.listdir(envs_dir)), sorted([used, 'cached', 'queued', 'fresh', 'late']))
+
+    def _git(self, repo_dir, *args):
+        return subprocess.check_output(['git', '-c', 'user.name=test', '-c', 'user.email=test@test.com'] + list(args),
+                                       cwd=repo_dir)
+
+    def test_update_project_git(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+
+        origin = os.path.join(work_dir, 'origin')
+        os.makedirs(os.path.join(origin, 'src'))
+        os.makedirs(os.path.join(origin, 'deploy'))
+        with open(os.path.join(origin, 'fabfile.py'), 'w') as f:
+            f.write('def deploy(): pass\n')
+        with open(os.path.join(origin, 'src', 'app.py'), 'w') as f:
+            f.write('app = None\n')
+        with open(os.path.join(origin, 'deploy', 'fabfile.py'), 'w') as f:
+            f.write('from helpers import *\n')
+        with open(os.path.join(origin, 'deploy', 'helpers.py'), 'w') as f:
+            f.write('def deploy(): pass\n')
+        self._git(origin, 'init', '--quiet')
+        self._git(origin, 'add', '.')
+        self._git(origin, 'commit', '--quiet', '-m', 'initial')
+
+        project = mommy.make(models.Project, use_repo_fabfile=True, repo_url='file://' + origin)
+        cache_dir = os.path.join(work_dir, 'caches')
+        repo_dir = os.path.join(cache_dir, 'project')
+
+        with override_settings(PUBLIC_DIR=work_dir):
+            fetched, seconds = update_project_git(project, cache_dir, repo_dir)
+
+            # Fabfiles at the root of the repo can import anything from it
+            self.assertGreater(fetched, 0)
+            self.assertTrue(os.path.exists(os.path.join(repo_dir, 'fabfile.py')))
+            self.assertTrue(os.path.exists(os.path.join(repo_dir, 'src', 'app.py')))
+
+            # Nothing to fetch while the remote hasn't moved
+            fetched, seconds = update_project_git(project, cache_dir, repo_dir)
+            self.assertEqual(fetched, 0)
+
+            # Another project on the same remote gets its own checkout from the same mirror
+            other_project = mommy.make(models.Project, use_repo_fabfile=True, repo_url=project.repo_url,
+                                       repo_fabfile_path='deploy/fabfile.py')
+            other_repo_dir = os.path.join(cache_dir, 'other_project')
+
+            # Only the fabfile's directory gets checked out, with the modules it imports
+            fetched, seconds = update_project_git(other_project, cache_dir, other_repo_dir)
+            self.assertTrue(os.path.exists(os.path.join(other_repo_dir, 'deploy', 'helpers.py')))
+            self.assertFalse(os.path.exists(os.path.join(other_repo_dir, 'src')))
+            self.assertFalse(os.path.exists(os.path.join(other_repo_dir, 'fabfile.py')))
+            self.assertEqual(len(os.listdir(os.path.join(work_dir, '.repo_mirrors'))), 1)
+
+            with open(os.path.join(origin, 'fabfile.py'), 'w') as f:
+                f.write('def deploy(): pass\ndef rollback(): pass\n')
+            self._git(origin, 'commit', '--quiet', '-am', 'rollback')
+
+            update_project_git(project, cache_dir, repo_dir)
+
+            with open(os.path.join(repo_dir, 'fabfile.py')) as f:
+                self.assertIn('rollback', f.read())
+
+            # Moving the project to another remote checks it out from that one's mirror
+            moved = os.path.join(work_dir, 'moved')
+            self._git(work_dir, 'clone', '--quiet', origin, moved)
+            with open(os.path.join(moved, 'fabfile.py'), 'w') as f:
+                f.write('def moved(): pass\n')
+            self._git(moved, 'commit', '--quiet', '-am', 'moved')
+
+            project.repo_url = 'file://' + moved
+            update_project_git(project, cache_dir, repo_dir)
+
+            with open(os.path.join(repo_dir, 'fabfile.py')) as f:
+                self.assertIn('moved', f.read())
+            self.assertEqual(len(os.listdir(os.path.join(work_dir, '.repo_mirrors'))), 2)
+
+    def test_file_lock(self):
+        public_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, public_dir)
+
+        events = []
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold_lock():
+            with file_lock('project_1'):
+                locked.set()
+                release.wait()
+                events.append('first released')
+
+        with override_settings(PUBLIC_DIR=public_dir):
+            thread = threading.Thread(target=hold_lock)
+            thread.start()
+            locked.wait()
+
+            # Other locks are independent
+            with file_lock('project_2'):
+                events.append('other locked')
+
+            release.set()
+            with file_lock('project_1'):
+                events.append('second locked')
+
+            thread.join()
+
+        self.assertEqual(events, ['other locked', 'first released', 'second locked'])
+
+    def test_read_process_output(self):
+        process = subprocess.Popen('echo first; sleep 0.2; echo second', stdout=subprocess.PIPE, shell=True)
+
+        self.assertEqual(''.join(read_process_output(process, timeout=0.05)), 'first\nsecond\n')
+        self.assertEqual(process.returncode, 0)
+
+    def test_read_process_output_left_open(self):
+        # The background sleep keeps stdout open after the shell exits
+        process = subprocess.Popen('echo done; sleep 5 &', stdout=subprocess.PIPE, shell=True)
+
+        self.assertEqual(''.join(read_process_output(process, timeout=0.05)), 'done\n')
+
+    def test_deployment_log_writer(self):
+        deployment = mommy.make(models.Deployment)
+
+        log = DeploymentLogWriter(deployment, max_delay=60, max_size=10)
+        log.write('first\n')
+        self.assertEqual(deployment.log_chunks.count(), 0)
+
+        log.write('second\n')
+        log.write('third\n')
+        self.assertEqual(list(deployment.log_chunks.values_list('sequence', 'text')), [(1, 'first\nsecond\n')])
+
+        log.flush()
+        self.assertEqual(deployment.output, 'first\nsecond\nthird\n')
+
+        # Appends to the existing chunks
+        log = DeploymentLogWriter(deployment)
+        log.write('fourth\n')
+        log.flush()
+
+        deployment = models.Deployment.objects.get(pk=deployment.pk)
+        self.assertEqual(deployment.output, 'first\nsecond\nthird\nfourth\n')
+        self.assertEqual(deployment.log_chunks.count(), 3)
+
+    def test_deployment_log_writer_split_character(self):
+        deployment = mommy.make(models.Deployment)
+        encoded = u'caf\xe9\n'.encode('utf-8')
+
+        # The read ends half way through the \xe9
+        log = DeploymentLogWriter(deployment, max_delay=60, max_size=1)
+        log.write(encoded[:4])
+        log.write(encoded[4:])
+        log.write('\xff')
+        log.close()
+
+        self.assertEqual(list(deployment.log_chunks.values_list('text', flat=True)), [u'caf', u'\xe9\n', u'\ufffd'])
+        self.assertEqual(models.Deployment.objects.get(pk=deployment.pk).output, u'caf\xe9\n\ufffd')
+
+    def test_archive_deployment_output(self):
+        deployment = mommy.make(models.Deployment, status=models.Deployment.SUCCESS, output='legacy\n')
+        mommy.make(models.DeploymentLogChunk, deployment=deployment, sequence=1, text='chunk\n' * 100)
+
+        archive = archive_deployment_output(deployment)
+
+        self.assertEqual(archive.size, 607)
+        self.assertLess(archive.compressed_size, archive.size)
+        self.assertGreater(archive.ratio, 1)
+
+        deployment = models.Deployment.objects.get(pk=deployment.pk)
+        self.assertIsNone(deployment.legacy_output)
+        self.assertEqual(deployment.log_chunks.count(), 0)
+        self.assertEqual(deployment.output, 'legacy\n' + 'chunk\n' * 100)
+
+        self.assertIsNone(archive_deployment_output(mommy.make(models.Deployment)))
+
+    def test_archive_deployment_logs_command(self):
+        finished = mommy.make(models.Deployment, status=models.Deployment.FAILED, output='failed\n')
+        running = mommy.make(models.Deployment, status=models.Deployment.RUNNING, output='running\n')
+
+        stdout = StringIO()
+        call_command('archive_deployment_logs', stdout=stdout)
+
+        self.assertIn('Archived 1 deployment logs', stdout.getvalue())
+        self.assertTrue(models.DeploymentLogArchive.objects.filter(deployment=finished).exists())
+        self.assertEqual(models.Deployment.objects.get(pk=running.pk).legacy_output, 'running\n')
+
+    def test_record_deployment_stats(self):
+        stage = mommy.make(models.Stage)
+        deployments = mommy.make(models.Deployment, stage=stage, status=models.Deployment.SUCCESS, _quantity=2)
+        failed = mommy.make(models.Deployment, stage=stage, status=models.Deployment.FAILED)
+        running = mommy.make(models.Deployment, stage=stage, status=models.Deployment.RUNNING)
+
+        for deployment in deployments + [failed, running]:
+            record_deployment_stats(deployment)
+
+        stats = dict(models.DeploymentStats.objects.filter(project=stage.project).values_list('status', 'count'))
+        self.assertEqual(stats, {models.Deployment.SUCCESS: 2, models.Deployment.FAILED: 1})
+        self.assertEqual(stage.project.get_deployment_count(), 3)
+
+    def test_deleted_deployment_stats(self):
+        stage = mommy.make(models.Stage)
+        deployments = mommy.make(models.Deployment, stage=stage, status=models.Deployment.SUCCESS, _quantity=3)
+        deployment_admin = admin.site._registry[models.Deployment]
+
+        for deployment in deployments:
+            record_deployment_stats(deployment)
+
+        def admin_save(deployment, **changes):
+            form = mock.Mock(initial={'date_deleted': deployment.date_deleted, 'status': deployment.status})
+            for field, value in changes.items():
+                setattr(deployment, field, value)
+            deployment_admin.save_model(None, deployment, form, True)
+
+        # Soft-deleted, as a failed deployment that was counted as successful
+        admin_save(deployments[0], date_deleted=timezone.now(), status=models.Deployment.FAILED)
+        self.assertEqual(stage.project.get_deployment_count(), 2)
+
+        # Saved again while deleted, and restored
+        admin_save(deployments[0], comments='Deleted')
+        self.assertEqual(stage.project.get_deployment_count(), 2)
+
+        admin_save(deployments[0], date_deleted=None)
+        self.assertEqual(stage.project.get_deployment_count(), 3)
+
+        # Deleted for good
+        deployments[1].delete()
+        self.assertEqual(stage.project.get_deployment_count(), 2)
+
+        admin_save(deployments[0], date_deleted=timezone.now())
+        deployments[0].delete()
+        self.assertEqual(stage.project.get_deployment_count(), 1)
+
+        # Saving doesn't query whether it was deleted
+        with self.assertNumQueries(1):
+            deployments[2].save()
+
+        self.assertEqual(rebuild_deployment_stats(), 1)
+
+    def test_rebuild_deployment_stats_command(self):
+        stage = mommy.make(models.Stage)
+        mommy.make(models.Deployment, stage=stage, status=models.Deployment.SUCCESS, _quantity=3)
+        mommy.make(models.Deployment, stage=stage, status=models.Deployment.PENDING)
+        mommy.make(models.DeploymentStats, stage=stage, project=stage.project, status=models.Deployment.FAILED,
+                   count=10)
+
+        stdout = StringIO()
+        call_command('rebuild_deployment_stats', stdout=stdout)
+
+        self.assertIn('Counted 3 finished deployments', stdout.getvalue())
+
+        stats = models.DeploymentStats.objects.get()
+        self.assertEqual((stats.stage, stats.project, stats.status, stats.count),
+                         (stage, stage.project, models.Deployment.SUCCESS, 3))
+        self.assertEqual(stats.day, timezone.now().date())
+
+
+class ExecutorTests(TestCase):
+
+    def test_claim_next_deployment(self):
+        host = mommy.make(Host)
+        stage = mommy.make(models.Stage)
+        stage.hosts.add(host)
+
+        first = mommy.make(models.Deployment, stage=stage, status=models.Deployment.QUEUED)
+        second = mommy.make(models.Deployment, stage=stage, status=models.Deployment.QUEUED)
+        other = mommy.make(models.Deployment, status=models.Deployment.QUEUED)
+
+        deployment = claim_next_deployment(per_host_limit=1)
+        self.assertEqual(deployment, first)
+        self.assertEqual(models.Deployment.objects.get(pk=first.pk).status, models.Deployment.RUNNING)
+
+        # The host is busy with the first one
+        self.assertEqual(claim_next_deployment(per_host_limit=1), other)
+        self.assertIsNone(claim_next_deployment(per_host_limit=1))
+
+        self.assertEqual(claim_next_deployment(per_host_limit=0), second)
+        self.assertIsNone(claim_next_deployment(per_host_limit=0))
+
+    def test_run_deployment(self):
+        deployment = mommy.make(models.Deployment, status=models.Deployment.RUNNING, command='echo deployed')
+
+        run_deployment(deployment)
+
+        deployment = models.Deployment.objects.get(pk=deployment.pk)
+        self.assertEqual(deployment.status, models.Deployment.SUCCESS)
+        self.assertEqual(deployment.output, 'deployed\n')
+        self.assertIsNone(deployment.pid)
+
+        deployment = mommy.make(models.Deployment, status=models.Deployment.RUNNING, command='exit 1')
+
+        run_deployment(deployment)
+
+        self.assertEqual(models.Deployment.objects.get(pk=deployment.pk).status, models.Deployment.FAILED)
+
+        # Finishing deployments counts them in the stats
+        self.assertEqual(models.DeploymentStats.objects.get(stage=deployment.stage).status, models.Deployment.FAILED)
+
+    def test_abandoned_deployments(self):
+        host = mommy.make(Host)
+        stage = mommy.make(models.Stage)
+        stage.hosts.add(host)
+
+        abandoned = mommy.make(models.Deployment, stage=stage, status=models.Deployment.RUNNING, pid='1234',
+                               heartbeat=timezone.now() - timedelta(minutes=5))
+        queued = mommy.make(models.Deployment, stage=stage, status=models.Deployment.QUEUED)
+        # Not run by a worker
+        streamed = mommy.make(models.Deployment, status=models.Deployment.RUNNING)
+
+        # The abandoned deployment doesn't keep the host busy
+        self.assertEqual(claim_next_deployment(per_host_limit=1), queued)
+
+        abandoned = models.Deployment.objects.get(pk=abandoned.pk)
+        self.assertEqual((abandoned.status, abandoned.pid), (models.Deployment.FAILED, None))
+        self.assertIn('stopped responding', abandoned.output)
+        self.assertEqual(models.DeploymentStats.objects.get(stage=stage).status, models.Deployment.FAILED)
+
+        self.assertEqual(models.Deployment.objects.get(pk=streamed.pk).status, models.Deployment.RUNNING)
+
+    @mock.patch('fabric_bolt.projects.executor.OUTPUT_SAVE_INTERVAL', 0.05)
+    def test_run_deployment_aborted(self):
+        deployment = mommy.make(models.Deployment, status=models.Deployment.RUNNING,
+                                command='echo started; sleep 30; echo finished')
+
+        def abort_then_renew(deployment):
+            # The web only marks it as aborted, the worker notices and stops its command (sleep included)
+            models.Deployment.objects.filter(pk=deployment.pk).update(status=models.Deployment.ABORTED)
+            return renew_heartbeat(deployment)
+
+        with mock.patch('fabric_bolt.projects.executor.renew_heartbeat', side_effect=abort_then_renew):
+            started = time.time()
+            run_deployment(deployment)
+
+        self.assertLess(time.time() - started, 10)
+
+        deployment = models.Deployment.objects.get(pk=deployment.pk)
+        self.assertEqual(deployment.status, models.Deployment.ABORTED)
+        self.assertEqual(deployment.output, 'started\n')
+
+    def test_run_deployment_worker_stopped(self):
+        deployment = mommy.make(models.Deployment, status=models.Deployment.RUNNING, command='sleep 30')
+
+        with mock.patch('fabric_bolt.projects.executor.read_process_output', side_effect=SystemExit), \
+                mock.patch('fabric_bolt.projects.executor.kill_deployment_process') as kill_deployment_process:
+            self.assertRaises(SystemExit, run_deployment, deployment)
+
+        self.assertTrue(kill_deployment_process.called)
+        kill_deployment_process.call_args[0][0].kill()
+
+        deployment = models.Deployment.objects.get(pk=deployment.pk)
+        self.assertEqual(deployment.status, models.Deployment.FAILED)
+        self.assertIn('worker running this deployment was stopped', deployment.output)
+
+    def test_run_deployment_workers_stopped(self):
+        self.addCleanup(signal.signal, signal.SIGTERM, signal.getsignal(signal.SIGTERM))
+
+        # The supervisor stops the pool while it waits
+        def sleep(seconds):
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        with mock.patch('fabric_bolt.projects.management.commands.run_deployment_workers.Process') as Process, \
+                mock.patch('fabric_bolt.projects.management.commands.run_deployment_workers.time.sleep', sleep):
+            Process.return_value.is_alive.return_value = True
+            self.assertRaises(SystemExit, call_command, 'run_deployment_workers', workers=2, stdout=StringIO())
+
+        self.assertEqual(Process.return_value.start.call_count, 2)
+        self.assertEqual(Process.return_value.terminate.call_count, 2)
+        self.assertEqual(Process.return_value.join.call_count, 2)
+
+    def test_follow_deployment_output(self):
+        deployment = mommy.make(models.Deployment, status=models.Deployment.SUCCESS, output='deployed\n')
+
+        self.assertEqual(list(follow_deployment_output(deployment)), ['deployed\n'])
+        self.assertEqual(deployment.status, models.Deployment.SUCCESS)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SidebarTests(TestCase):
+
+    def test_sidebar_lists(self):
+        host = mommy.make(Host, alias='web1')
+        project = mommy.make(models.Project, name='Project')
+
+        # Nothing is fetched until a template needs it
+        with self.assertNumQueries(0):
+            context = sidebar_lists(None)
+
+        with self.assertNumQueries(1):
+            self.assertEqual([(item.pk, unicode(item)) for item in context['sidebar_hosts']], [(host.pk, u'web1')])
+            self.assertEqual(len(context['sidebar_hosts']), 1)
+
+        # Later requests get the cached list
+        with self.assertNumQueries(0):
+            self.assertEqual(list(sidebar_lists(None)['sidebar_hosts']), [(host.pk, u'web1')])
+
+        # Until a host changes
+        host.alias = 'web2'
+        host.save()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(list(sidebar_lists(None)['sidebar_hosts']), [(host.pk, u'web2')])
+
+        list(sidebar_lists(None)['sidebar_projects'])
+        project.delete()
+
+        self.assertEqual(list(sidebar_lists(None)['sidebar_projects']), [])
+
+        user = mommy.make(User)
+        self.assertEqual([item.pk for item in sidebar_lists(None)['sidebar_users']], [user.pk])
+        user.delete()
+
+        self.assertEqual(list(sidebar_lists(None)['sidebar_users']), [])
+
+    def test_sidebar_receivers(self):
+        # Saving anything else doesn't even call them
+        self.assertIn(invalidate_sidebar_lists, post_save._live_receivers(Host))
+        self.assertIn(invalidate_sidebar_lists, post_delete._live_receivers(User))
+        self.assertNotIn(invalidate_sidebar_lists, post_save._live_receivers(Session))
+        self.assertNotIn(invalidate_sidebar_lists, post_save._live_receivers(models.DeploymentLogChunk))
+
+
+class DeploymentHistoryBenchmarkTests(TestCase):
+    """Seeds a large deployment history and checks that history pages stay cheap"""
+
+    DEPLOYMENTS = 10000
+
+    def setUp(self):
+        password = 'mypassword'
+        self.user = User.objects.create_superuser(email='myemail@test.com', password=password)
+        self.client.login(email=self.user.email, password=password)
+
+        self.project = mommy.make(models.Project)
+        self.stages = mommy.make(models.Stage, project=self.project, _quantity=4)
+        self.task = mommy.make(models.Task)
+
+        self.seed(self.DEPLOYMENTS)
+
+    def seed(self, count):
+        models.Deployment.objects.bulk_create([
+            models.Deployment(user=self.user, stage=self.stages[i % len(self.stages)], task=self.task,
+                              status=models.Deployment.SUCCESS, legacy_output='output line\n' * 100)
+            for i in range(count)
+        ], batch_size=500)
+
+    def test_table_queryset(self):
+        queryset = models.Deployment.objects.filter(stage=self.stages[0]).for_table()
+
+        self.assertNotIn('."output"', str(queryset.query))
+
+        with self.assertNumQueries(1):
+            for deployment in queryset[:20]:
+                # Everything DeploymentTable renders
+                deployment.date_created, deployment.get_status_display(), deployment.stage.name
+                deployment.stage.project_id, deployment.task.name
+
+    @skipUnless(connection.vendor == 'sqlite', 'Query plans are SQLite specific')
+    def test_history_uses_index(self):
+        queryset = models.Deployment.objects.filter(stage=self.stages[0]).for_table()[:20]
+        sql, params = queryset.query.sql_with_params()
+
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+
+        self.assertIn('USING INDEX', plan)
+        # The index gives the order, no sorting of the whole history
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_history_page(self):
+        url = reverse('projects_stage_deployment_list', args=(self.project.pk, self.stages[0].pk))
+        self.client.get(url)  # warm up sessions, templates and the like
+
+        start = time.time()
+        with CaptureQueriesContext(connection) as queries:
+            result = self.client.get(url)
+        elapsed = time.time() - start
+
+        self.assertEqual(result.status_code, 200)
+        if BENCHMARKS:
+            self.assertLess(elapsed, 1)
+
+        # Doubling the history doesn't add queries
+        self.seed(self.DEPLOYMENTS)
+
+        with CaptureQueriesContext(connection) as more_queries:
+            self.client.get(url)
+
+        self.assertEqual(len(more_queries), len(queries))
+
+    def test_cursor_pagination(self):
+        queryset = models.Deployment.objects.filter(stage=self.stages[0]).for_table()
+        expected = list(queryset.order_by('-date_created', '-pk').values_list('pk', flat=True))
+
+        pages = []
+        cursor = None
+        while True:
+            table = tables.DeploymentTable(queryset)
+            table.paginate(per_page=200, cursor_pagination=True, cursor=cursor)
+            pages.append([row.record.pk for row in table.page.object_list])
+
+            self.assertEqual(table.page.count, 1000)
+            self.assertTrue(table.page.count_is_estimate)
+
+            if not table.page.has_next():
+                break
+            cursor = table.page.next_cursor
+
+        self.assertEqual(sum(pages, []), expected)
+
+        # And back again
+        table.paginate(per_page=200, cursor_pagination=True, cursor=table.page.previous_cursor)
+        self.assertEqual([row.record.pk for row in table.page.object_list], pages[-2])
+
+    def test_deep_history_page(self):
+        url = reverse('projects_stage_deployment_list', args=(self.project.pk, self.stages[0].pk))
+        self.client.get(url)
+
+        with CaptureQueriesContext(connection) as first_queries:
+            self.client.get(url)
+
+        deep = models.Deployment.objects.filter(stage=self.stages[0]).order_by('-date_created', '-pk')[2000]
+        cursor = encode_cursor('n', deep.date_created, deep.pk)
+
+        start = time.time()
+        with CaptureQueriesContext(connection) as deep_queries:
+            result = self.client.get(url, {'cursor': cursor})
+        elapsed = time.time() - start
+
+        self.assertEqual(result.status_code, 200)
+        if BENCHMARKS:
+            self.assertLess(elapsed, 1)
+        self.assertEqual(len(deep_queries), len(first_queries))
+        self.assertFalse([query for query in deep_queries.captured_queries if 'OFFSET' in query['sql']])
+        self.assertContains(result, 'Newer')
+
+
+class DashboardBenchmarkTests(TestCase):
+    """Seeds a large deployment history across many projects and checks the dashboard chart"""
+
+    PROJECTS = 100 if BENCHMARKS else 10
+    DEPLOYMENTS = 100000 if BENCHMARKS else 9000
+    DAYS = 90
+
+    def setUp(self):
+        password = 'mypassword'
+        self.user = User.objects.create_superuser(email='myemail@test.com', password=password)
+        self.client.login(email=self.user.email, password=password)
+
+        self.projects = mommy.make(models.Project, _quantity=self.PROJECTS)
+        self.stages = [mommy.make(models.Stage, project=project) for project in self.projects]
+        self.task = mommy.make(models.Task)
+
+    def seed(self, count, days):
+        """Spread `count` deployments over the stages and the last `days` days, returns the expected counts"""
+
+        expected = {}
+        now = timezone.now()
+        per_day = count // days
+
+        for day in range(days):
+            last_pk = models.Deployment.objects.aggregate(pk=Max('pk'))['pk'] or 0
+
+            models.Deployment.objects.bulk_create([
+                models.Deployment(user=self.user, stage=self.stages[i % len(self.stages)], task=self.task,
+                                  status=models.Deployment.SUCCESS)
+                for i in range(day, day + per_day)
+            ], batch_size=500)
+
+            date_created = now - timedelta(days=day)
+            models.Deployment.objects.filter(pk__gt=last_pk).update(date_created=date_created)
+
+            for i in range(day, day + per_day):
+                key = (self.stages[i % len(self.stages)].project_id, date_created.strftime('%m/%d'))
+                expected[key] = expected.get(key, 0) + 1
+
+        rebuild_deployment_stats()
+
+        return expected
+
+    def test_dashboard_history_chart(self):
+        expected = self.seed(self.DEPLOYMENTS, self.DAYS)
+        url = reverse('index')
+        self.client.get(url)  # warm up sessions, templates and the like
+
+        start = time.time()
+        with CaptureQueriesContext(connection) as queries:
+            result = self.client.get(url)
+        elapsed = time.time() - start
+
+        self.assertEqual(result.status_code, 200)
+        if BENCHMARKS:
+            self.assertLess(elapsed, 2)
+
+        chart_data = result.context['line_chart'].get_data()
+        projects = list(models.Project.active_records.all())
+
+        self.assertEqual(chart_data[0], ['Day'] + [project.name for project in projects])
+        self.assertEqual(len(chart_data), 1 + 46)
+
+        for row in chart_data[1:]:
+            self.assertEqual(row[1:], [expected.get((project.pk, row[0]), 0) for project in projects])
+
+        # The charts are drawn from the stats, deployments aren't touched
+        self.assertFalse([query for query in queries.captured_queries if 'projects_deployment"' in query['sql']])
+        pie_data = result.context['pie_chart'].get_data()
+        self.assertEqual(pie_data[1:], [[models.Deployment.SUCCESS, sum(expected.values())]])
+
+        self.seed(self.PROJECTS, 1)
+        with CaptureQueriesContext(connection) as more_queries:
+            self.client.get(url)
+
+        self.assertEqual(len(more_queries), len(queries))
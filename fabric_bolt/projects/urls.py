@@ -23,6 +23,7 @@ urlpatterns = patterns(
     url(r'^(?P<project_id>\w+)/stage/(?P<stage_id>\d+)/deployment/create/(?P<task_name>\w+)/$', views.DeploymentCreate.as_view(), name='projects_deployment_create'),
     url(r'^(?P<project_id>\w+)/stage/(?P<stage_id>\d+)/deployment/(?P<pk>\d+)/$', views.DeploymentDetail.as_view(), name='projects_deployment_detail'),
     url(r'^(?P<project_id>\w+)/stage/(?P<stage_id>\d+)/deployment/(?P<pk>\d+)/output/$', views.DeploymentOutputStream.as_view(), name='projects_deployment_output'),
+    url(r'^(?P<project_id>\w+)/stage/(?P<stage_id>\d+)/deployment/(?P<pk>\d+)/log/$', views.DeploymentLog.as_view(), name='projects_deployment_log'),
 
     url(r'^(?P<project_id>\w+)/stage/$', views.ProjectStageList.as_view(), name='projects_stage_list'),
     url(r'^(?P<project_id>\w+)/stage/create/$', views.ProjectStageCreate.as_view(), name='projects_stage_create'),
@@ -1,19 +1,51 @@
 import os
 import re
+import json
+import codecs
+import time
+import errno
+import fcntl
+import logging
+import zlib
+import shutil
+import hashlib
+import posixpath
 import subprocess
+from contextlib import contextmanager
 
 from django.utils.text import slugify
 from django.conf import settings
 from django.contrib import messages
+from django.core import signing
 from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, F
+from django.utils import timezone
+from django.utils.encoding import force_bytes
 
+from gevent import socket
+from gevent.socket import wait_read
 from virtualenv import create_environment
 
+from fabric_bolt.projects.models import Project, Deployment, DeploymentLogChunk, DeploymentLogArchive, \
+    DeploymentStats
+from fabric_bolt.projects.signals import deployment_finished
+
+logger = logging.getLogger(__name__)
+
 # These options are passed to Fabric as: fab task --abort-on-prompts=True --user=root ...
 fabric_special_options = ['no_agent', 'forward-agent', 'config', 'disable-known-hosts', 'keepalive',
                           'password', 'parallel', 'no-pty', 'reject-unknown-hosts', 'skip-bad-hosts', 'timeout',
                           'command-timeout', 'user', 'warn-only', 'pool-size']
 
+# Written into a shared virtualenv once its requirements are installed
+VIRTUAL_ENV_READY_MARKER = '.fabric-bolt-requirements'
+
+# Keeps deployment log tokens from being valid signatures for anything else
+DEPLOYMENT_LOG_TOKEN_SALT = 'fabric_bolt.projects.deployment_log'
+
+FABFILE_INTROSPECTION_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fabfile_introspection.py')
+
 
 def check_output_with_ssh_key(command):
     if getattr(settings, 'GIT_SSH_KEY_LOCATION', None):
@@ -26,51 +58,379 @@ def check_output_with_ssh_key(command):
         return out
 
 
-def update_project_git(project, cache_dir, repo_dir):
-    if not os.path.exists(repo_dir):
-        if not os.path.exists(cache_dir):
-            os.makedirs(cache_dir)
+@contextmanager
+def file_lock(name):
+    """
+    Exclusive lock on name for the duration of the with block, shared by every thread and process on this machine.
 
-        check_output_with_ssh_key('git clone {} {}'.format(project.repo_url, repo_dir))
-    else:
+    Polls instead of blocking in flock() so waiting doesn't stall everything else under gevent.
+    """
+
+    locks_dir = os.path.join(settings.PUBLIC_DIR, '.locks')
+
+    try:
+        os.makedirs(locks_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    with open(os.path.join(locks_dir, '{}.lock'.format(name)), 'a') as lock_file:
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                time.sleep(0.1)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+
+    return size
+
+
+def get_git_path(repo_dir, path):
+    """Location of path inside the git dir of repo_dir, which for worktrees lives in the mirror"""
+
+    git_path = subprocess.check_output(['git', 'rev-parse', '--git-path', path], cwd=repo_dir).strip()
+    return os.path.join(repo_dir, git_path)
+
+
+def get_sparse_checkout_dir(project):
+    """
+    The directory of the repo a project's checkout is limited to: the one its fabfile is in, as fabfiles import the
+    modules next to them. Empty for fabfiles at the root of the repo, they get all of it.
+    """
+
+    return posixpath.dirname(project.repo_fabfile_path.strip('/'))
+
+
+def update_sparse_checkout(project, repo_dir):
+    """
+    Limit the project's checkout to its fabfile's directory. Returns True if the checkout has to be updated to match.
+    """
+
+    sparse_checkout_file = get_git_path(repo_dir, 'info/sparse-checkout')
+    sparse_checkout_dir = get_sparse_checkout_dir(project)
+    pattern = '/{}/\n'.format(sparse_checkout_dir) if sparse_checkout_dir else '/*\n'
+
+    if os.path.exists(sparse_checkout_file):
+        with open(sparse_checkout_file) as f:
+            if f.read() == pattern:
+                return False
+    elif not os.path.exists(os.path.dirname(sparse_checkout_file)):
+        os.makedirs(os.path.dirname(sparse_checkout_file))
+
+    subprocess.check_output(['git', 'config', 'core.sparseCheckout', 'true'], cwd=repo_dir)
+
+    with open(sparse_checkout_file, 'w') as f:
+        f.write(pattern)
+
+    return True
+
+
+def get_repo_mirror_dir(project):
+    """Every project pointing at the same remote shares one bare mirror"""
+
+    return os.path.join(settings.PUBLIC_DIR, '.repo_mirrors', hashlib.sha1(project.repo_url.encode('utf-8')).hexdigest())
+
+
+def get_worktree_mirror_dir(repo_dir):
+    """The repository a worktree belongs to, None if that's gone"""
+
+    try:
+        common_dir = subprocess.check_output(['git', 'rev-parse', '--git-common-dir'], cwd=repo_dir,
+                                             stderr=subprocess.STDOUT).strip()
+    except subprocess.CalledProcessError:
+        return None
+
+    return os.path.realpath(os.path.join(repo_dir, common_dir))
+
+
+def update_repo_mirror(project, mirror_dir):
+    """
+    Make sure the bare mirror of the project's remote has its latest commit. Returns that commit.
+
+    Only the latest commit is fetched, without any blobs (they're fetched when a worktree checks them out), and
+    nothing is fetched at all while the remote HEAD hasn't moved.
+    """
+
+    if not os.path.exists(mirror_dir):
         check_output_with_ssh_key(
-            'cd {0};git stash;git pull'.format(repo_dir)
+            'git clone --quiet --bare --depth 1 --filter=blob:none {} {}'.format(project.repo_url, mirror_dir)
         )
+    else:
+        remote_head = check_output_with_ssh_key('cd {};git ls-remote origin HEAD'.format(mirror_dir)).split()
+        local_head = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=mirror_dir).strip()
+
+        if not remote_head or remote_head[0] != local_head:
+            check_output_with_ssh_key(
+                'cd {};git fetch --quiet --depth 1 --filter=blob:none origin HEAD;'
+                'git update-ref HEAD FETCH_HEAD'.format(mirror_dir)
+            )
+
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=mirror_dir).strip()
+
+
+def update_project_git(project, cache_dir, repo_dir):
+    """
+    Bring the project's checkout up to date. Returns the number of bytes fetched and the seconds it took.
+
+    The checkout is a worktree of the bare mirror shared by all projects on the same remote, limited to the
+    fabfile's directory with a sparse checkout.
+    """
+
+    started = time.time()
+
+    mirror_dir = get_repo_mirror_dir(project)
+    objects_dir = os.path.join(mirror_dir, 'objects')
+    size_before = get_directory_size(objects_dir) if os.path.exists(objects_dir) else 0
+
+    # Worktrees are added to and pruned from the mirror, and missing blobs fetched into it, so all of it is done
+    # under the mirror's lock
+    with file_lock('mirror_{}'.format(os.path.basename(mirror_dir))):
+        head = update_repo_mirror(project, mirror_dir)
+
+        if os.path.isdir(os.path.join(repo_dir, '.git')):
+            # A full clone from before repos were mirrored
+            shutil.rmtree(repo_dir)
+        elif os.path.exists(repo_dir) and get_worktree_mirror_dir(repo_dir) != os.path.realpath(mirror_dir):
+            # A worktree of the mirror of the project's previous repo_url
+            shutil.rmtree(repo_dir)
+
+        if not os.path.exists(repo_dir):
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+
+            subprocess.check_output(['git', 'worktree', 'prune'], cwd=mirror_dir)
+            subprocess.check_output(['git', 'worktree', 'add', '--quiet', '--no-checkout', '--detach', repo_dir, head],
+                                    cwd=mirror_dir)
+            update_sparse_checkout(project, repo_dir)
+            checkout_needed = True
+        else:
+            checkout_needed = update_sparse_checkout(project, repo_dir) or \
+                subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo_dir).strip() != head
+
+        if checkout_needed:
+            # Missing blobs under the fabfile's directory get fetched here
+            check_output_with_ssh_key('cd {};git reset --quiet --hard {}'.format(repo_dir, head))
+
+    fetched = max(0, get_directory_size(objects_dir) - size_before)
+    seconds = time.time() - started
+
+    logger.info('Refreshed repo of project {} ({}): {} bytes fetched in {:.2f}s'.format(
+        project.pk, project.repo_url, fetched, seconds))
+
+    return fetched, seconds
+
+
+def normalize_requirements(requirements):
+    """Sorted, de-duplicated list of the pip requirements entered on a project"""
+
+    return sorted(set(line.strip() for line in (requirements or '').splitlines() if line.strip()))
+
+
+def get_requirements_digest(requirements):
+    return hashlib.sha1('\n'.join(normalize_requirements(requirements)).encode('utf-8')).hexdigest()
+
 
+def get_virtual_envs_dir():
+    return os.path.join(settings.PUBLIC_DIR, '.virtualenvs')
+
+
+def update_project_requirements(project, env_dir, activate_loc):
+    pip_installs = ' '.join(normalize_requirements(project.fabfile_requirements))
+
+    if pip_installs:
+        check_output_with_ssh_key('source {} && cd {};pip install {}'.format(activate_loc, env_dir, pip_installs))
+
+
+def setup_virtual_env_if_needed(project):
+    """
+    Returns the activate script of the virtualenv for the project's fabfile requirements, building it if needed.
+
+    Virtualenvs are shared by every project with the same requirements, so pip only runs the first time a set of
+    requirements shows up.
+    """
+
+    digest = get_requirements_digest(project.fabfile_requirements)
+    env_dir = os.path.join(get_virtual_envs_dir(), digest)
+    activate_loc = os.path.join(env_dir, 'bin', 'activate')
+    ready_marker = os.path.join(env_dir, VIRTUAL_ENV_READY_MARKER)
+
+    # Also keeps remove_unused_virtual_envs from deleting it while we look
+    with file_lock('virtualenv_{}'.format(digest)):
+        if os.path.exists(ready_marker):
+            # Marks it as in use for remove_unused_virtual_envs
+            os.utime(ready_marker, None)
+            return activate_loc
+
+        if os.path.exists(env_dir):
+            # Left over from an install that never finished
+            shutil.rmtree(env_dir)
 
-def setup_virtual_env_if_needed(repo_dir):
-    env_dir = os.path.join(repo_dir, 'env')
-    if not os.path.exists(env_dir):
         os.makedirs(env_dir)
         create_environment(env_dir)
+        update_project_requirements(project, env_dir, activate_loc)
+
+        with open(ready_marker, 'w') as marker:
+            marker.write('\n'.join(normalize_requirements(project.fabfile_requirements)))
+
+    return activate_loc
+
+
+def get_virtual_env_name(activate_loc):
+    """The shared virtualenv an activate script belongs to, None if it isn't one of them"""
+
+    if not activate_loc:
+        return None
+
+    relative_path = os.path.relpath(activate_loc, get_virtual_envs_dir())
+    if relative_path.startswith(os.pardir):
+        return None
+
+    return relative_path.split(os.sep)[0]
 
 
-def update_project_requirements(project, repo_dir, activate_loc):
-    pip_installs = ' '.join(project.fabfile_requirements.splitlines())
+def get_virtual_envs_in_use(project_pks):
+    """
+    Names of the shared virtualenvs the projects' current requirements, their cached fabfile paths (see
+    get_fabfile_path) or deployments that haven't finished yet need, and of those handed out by
+    setup_virtual_env_if_needed less than FABRIC_TASK_CACHE_TIMEOUT ago.
+    """
+
+    requirements = Project.objects.filter(pk__in=project_pks, use_repo_fabfile=True)\
+        .values_list('fabfile_requirements', flat=True)
+    in_use = set(get_requirements_digest(project_requirements) for project_requirements in requirements)
+
+    cached_paths = cache.get_many(['project_{}_fabfile_path'.format(pk) for pk in project_pks])
+    in_use.update(get_virtual_env_name(activate_loc) for fabfile_path, activate_loc in cached_paths.values())
+
+    unfinished = Deployment.objects.filter(status__in=[Deployment.PENDING, Deployment.QUEUED, Deployment.RUNNING])
+    in_use.update(get_virtual_env_name(activate_loc) for activate_loc in
+                  unfinished.exclude(virtualenv=None).values_list('virtualenv', flat=True))
+
+    # The path they were handed out for may not be cached yet
+    envs_dir = get_virtual_envs_dir()
+    recently_used = time.time() - settings.FABRIC_TASK_CACHE_TIMEOUT
+    for name in os.listdir(envs_dir) if os.path.exists(envs_dir) else []:
+        ready_marker = os.path.join(envs_dir, name, VIRTUAL_ENV_READY_MARKER)
+        if os.path.exists(ready_marker) and os.path.getmtime(ready_marker) > recently_used:
+            in_use.add(name)
+
+    return in_use
+
+
+def remove_unused_virtual_envs(projects):
+    """
+    Delete the shared virtualenvs none of the given projects need anymore (see get_virtual_envs_in_use). Returns the
+    removed directories.
+    """
+
+    envs_dir = get_virtual_envs_dir()
+    if not os.path.exists(envs_dir):
+        return []
+
+    project_pks = [project.pk for project in projects]
+    in_use = get_virtual_envs_in_use(project_pks)
+
+    removed = []
+    for name in os.listdir(envs_dir):
+        if name in in_use:
+            continue
+
+        with file_lock('virtualenv_{}'.format(name)):
+            # Somebody may have started using it since, setup_virtual_env_if_needed touches it under this lock
+            if name in get_virtual_envs_in_use(project_pks):
+                continue
+
+            shutil.rmtree(os.path.join(envs_dir, name))
 
-    check_output_with_ssh_key('source {} && cd {};pip install {}'.format(activate_loc, repo_dir, pip_installs))
+        removed.append(os.path.join(envs_dir, name))
 
+    if removed:
+        # No project may keep a cached path into a removed virtualenv
+        cache_keys = ['project_{}_fabfile_path'.format(pk) for pk in Project.objects.values_list('pk', flat=True)]
+        removed_names = set(os.path.basename(env_dir) for env_dir in removed)
+        cache.delete_many([key for key, (fabfile_path, activate_loc) in cache.get_many(cache_keys).items()
+                           if get_virtual_env_name(activate_loc) in removed_names])
+
+    return removed
+
+
+def get_fabfile_commit(project, fabfile_path):
+    """The commit a repo fabfile is checked out at, None for projects using the default fabfile"""
+
+    if not project.use_repo_fabfile:
+        return None
+
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(fabfile_path)).strip()
+
+
+def get_fabfile_digest(project, fabfile_path):
+    """
+    Digest of everything a project's task list depends on: the fabfile and the pip requirements it runs with.
+
+    Repo fabfiles can import other modules from their repo, so for those the HEAD commit is used rather than the
+    contents of fabfile.py.
+    """
+
+    digest = hashlib.sha1()
+
+    if project.use_repo_fabfile:
+        digest.update(get_fabfile_commit(project, fabfile_path))
+    else:
+        with open(fabfile_path, 'rb') as fabfile:
+            digest.update(fabfile.read())
+
+    digest.update(get_requirements_digest(project.fabfile_requirements))
+
+    return digest.hexdigest()
+
+
+def get_fabfile_path(project, refresh=False):
+    """
+    Returns the (fabfile path, virtualenv activate script) to use for a project.
+
+    Repo fabfiles are pulled and get their requirements installed at most once every FABRIC_TASK_CACHE_TIMEOUT,
+    unless refresh is set.
+    """
 
-def get_fabfile_path(project):
     if project.use_repo_fabfile:
         cache_key = 'project_{}_fabfile_path'.format(project.pk)
-        cached_result = cache.get(cache_key)
+        cached_result = None if refresh else cache.get(cache_key)
 
         if cached_result:
             return cached_result
 
-        cache_dir = os.path.join(settings.PUBLIC_DIR, '.repo_caches')
-        repo_dir = os.path.join(cache_dir, slugify(project.name))
+        # Only one refresh per project at a time. Whoever waited on it gets the result it cached.
+        with file_lock('project_{}'.format(project.pk)):
+            cached_result = None if refresh else cache.get(cache_key)
+
+            if cached_result:
+                return cached_result
 
-        update_project_git(project, cache_dir, repo_dir)
-        setup_virtual_env_if_needed(repo_dir)
-        activate_loc = os.path.join(repo_dir, 'env', 'bin', 'activate')
+            cache_dir = os.path.join(settings.PUBLIC_DIR, '.repo_caches')
+            repo_dir = os.path.join(cache_dir, slugify(project.name))
 
-        update_project_requirements(project, repo_dir, activate_loc)
+            update_project_git(project, cache_dir, repo_dir)
+            activate_loc = setup_virtual_env_if_needed(project)
 
-        result = os.path.join(repo_dir, 'fabfile.py'), activate_loc
-        cache.set(cache_key, result, settings.FABRIC_TASK_CACHE_TIMEOUT)
-        return result
+            result = os.path.join(repo_dir, project.repo_fabfile_path), activate_loc
+            cache.set(cache_key, result, settings.FABRIC_TASK_CACHE_TIMEOUT)
+            return result
     else:
         return settings.FABFILE_PATH, None
 
@@ -103,48 +463,100 @@ def parse_task_details(name, task_output):
     return name, docstring, arguments
 
 
-def get_fabric_tasks(project):
+def parse_introspection_output(output):
     """
-    Generate a list of fabric tasks that are available
+    Turn the JSON printed by fabfile_introspection.py into the (name, docstring, arguments) tuples used everywhere
+    else. Arguments with a default value come back as (name, default) tuples, just like parse_task_details.
+    """
+
+    tasks = []
+    for task in json.loads(output):
+        arguments = [tuple(arg) if isinstance(arg, list) else arg for arg in task['arguments']]
+        tasks.append((task['name'], task['docstring'], arguments))
+
+    return tasks
+
+
+def get_fabric_tasks_cache_key(project, fabfile_path):
+    # The key changes whenever the fabfile or its requirements do, so entries never have to expire
+    return 'fabfile_tasks_{}'.format(get_fabfile_digest(project, fabfile_path))
+
+
+def get_cached_fabric_tasks(project):
+    """
+    The tasks of a project as cached by an earlier load_fabric_tasks, None if there are none. Never pulls, installs
+    or introspects anything.
+    """
+
+    if project.use_repo_fabfile:
+        cached_path = cache.get('project_{}_fabfile_path'.format(project.pk))
+
+        if not cached_path:
+            return None
+
+        fabfile_path = cached_path[0]
+    else:
+        fabfile_path = settings.FABFILE_PATH
+
+    return cache.get(get_fabric_tasks_cache_key(project, fabfile_path))
+
+
+def load_fabric_tasks(project):
     """
+    Introspect a project's fabfile, unless its tasks are cached already, and cache them. Unlike get_fabric_tasks this
+    raises whatever went wrong.
+    """
+
+    fabfile_path, activate_loc = get_fabfile_path(project)
 
-    cache_key = 'project_{}_fabfile_tasks'.format(project.pk)
+    cache_key = get_fabric_tasks_cache_key(project, fabfile_path)
     cached_result = cache.get(cache_key)
 
     if cached_result:
         return cached_result
 
-    try:
-        fabfile_path, activate_loc = get_fabfile_path(project)
+    # Load the fabfile a single time and get every task's details back in one go
+    if activate_loc:
+        output = subprocess.check_output(
+            'source {};python {} {}'.format(activate_loc, FABFILE_INTROSPECTION_SCRIPT, fabfile_path),
+            shell=True
+        )
+    else:
+        output = subprocess.check_output([settings.FABRIC_PYTHON, FABFILE_INTROSPECTION_SCRIPT, fabfile_path])
 
-        if activate_loc:
-            output = subprocess.check_output('source {};fab --list --list-format=short --fabfile={}'.format(activate_loc, fabfile_path), shell=True)
-        else:
-            output = subprocess.check_output(['fab', '--list', '--list-format=short', '--fabfile={}'.format(fabfile_path)])
+    tasks = parse_introspection_output(output)
 
-        lines = output.splitlines()
-        tasks = []
-        for line in lines:
-            name = line.strip()
-            if activate_loc:
-                o = subprocess.check_output(
-                    'source {};fab --display={} --fabfile={}'.format(activate_loc, name, fabfile_path),
-                    shell=True
-                )
-            else:
-                o = subprocess.check_output(
-                    ['fab', '--display={}'.format(name), '--fabfile={}'.format(fabfile_path)]
-                )
+    cache.set(cache_key, tasks, None)
+
+    return tasks
 
-            tasks.append(parse_task_details(name, o))
 
-        cache.set(cache_key, tasks, settings.FABRIC_TASK_CACHE_TIMEOUT)
+def get_fabric_tasks(project, cached_only=None):
+    """
+    Generate a list of fabric tasks that are available
+
+    When cached_only is set, which it is by default if FABRIC_TASKS_PREWARMED is, only the tasks prewarm_fabfiles
+    cached are returned, so pages never pull a repo, install requirements or load a fabfile themselves.
+    """
+
+    if cached_only is None:
+        cached_only = settings.FABRIC_TASKS_PREWARMED
+
+    try:
+        if cached_only:
+            tasks = get_cached_fabric_tasks(project) or []
+        else:
+            tasks = load_fabric_tasks(project)
     except Exception as e:
         tasks = []
 
     return tasks
 
 
+class UnknownTaskError(ValueError):
+    """A task that isn't in the task list of the project's fabfile, or whose task list isn't known"""
+
+
 def get_task_details(project, task_name):
     for details in get_fabric_tasks(project):
         if details[0] == task_name:
@@ -163,6 +575,13 @@ def clean_key_string(key):
 
 def clean_value_string(value):
     value = value.replace('"', '\\"')  # escape double quotes
+
+    return clean_fab_value_string(value)
+
+
+def clean_fab_value_string(value):
+    """Only the escaping fab itself needs, for values the shell passes on as they are (see build_command secrets)"""
+
     value = value.replace(',', '\,')  # escape commas, that would be adding a new value
     value = value.replace('=', '\=')  # escape = because that would be setting a new key
 
@@ -200,11 +619,31 @@ def update_config_values_from_session(configs, session):
     return configs, arg_values
 
 
-def build_command(deployment, session, abort_on_prompts=True):
+def build_command(deployment, session, abort_on_prompts=True, secrets=None):
+    """
+    Build the fab command line for a deployment.
+
+    When a secrets dict is given, sensitive values (prompted for or stored) are left out of the command: it refers to
+    them as shell variables instead, and their values are added to secrets to be passed in the environment. The shell
+    doesn't unescape expanded variables, so those values only get fab's own escaping.
+    """
+
     # Get the dictionary of configurations for this stage
     configs = deployment.stage.get_configurations()
     configs, arg_values = update_config_values_from_session(configs, session)
 
+    if secrets is not None:
+        for key, config in configs.iteritems():
+            if not config.sensitive_value or config.get_value() is None:
+                continue
+
+            if config.data_type in (config.BOOLEAN_TYPE, config.NUMBER_TYPE):
+                continue
+
+            name = 'FABRIC_BOLT_SECRET_{}'.format(len(secrets))
+            secrets[name] = clean_fab_value_string(unicode(config.get_value()))
+            config.set_value('${' + name + '}')
+
     task_args = [key for key, config in configs.iteritems() if config.task_argument and config.task_name == deployment.task.name]
     task_configs = [key for key, config in configs.iteritems() if not config.task_argument]
 
@@ -219,6 +658,9 @@ def build_command(deployment, session, abort_on_prompts=True):
     command = 'fab ' + deployment.task.name
 
     task_details = get_task_details(deployment.stage.project, deployment.task.name)
+    if task_details is None:
+        # Also what a task list that isn't cached (yet) with FABRIC_TASKS_PREWARMED looks like
+        raise UnknownTaskError('"{}" is not a valid task.'.format(deployment.task.name))
 
     task_args = list(set(task_args + [x[0] if isinstance(x, tuple) else x for x in task_details[2]]))
 
@@ -262,3 +704,285 @@ def build_command(deployment, session, abort_on_prompts=True):
         return 'source {};'.format(active_loc) + ' ' + command
     else:
         return command
+
+
+def freeze_deployment(deployment, configuration_values, abort_on_prompts=True):
+    """
+    Resolve everything needed to run a deployment and store it on the deployment (it is not saved).
+
+    Running the deployment afterwards is only a matter of spawning its command, without any repo, virtualenv or
+    fabfile introspection work. start_deployment_process refuses to run it with any other fabfile commit.
+    """
+
+    project = deployment.stage.project
+    fabfile_path, activate_loc = get_fabfile_path(project)
+
+    secrets = {}
+    deployment.command = build_command(
+        deployment,
+        {'configuration_values': dict(configuration_values)},
+        abort_on_prompts,
+        secrets=secrets
+    )
+    deployment.fabfile_path = fabfile_path
+    deployment.fabfile_commit = get_fabfile_commit(project, fabfile_path)
+    deployment.virtualenv = activate_loc
+    deployment.secrets = json.dumps(secrets) if secrets else None
+
+
+def start_deployment_process(deployment, **kwargs):
+    """
+    Spawn the frozen command of a deployment, passing its secrets in the environment.
+
+    The secrets are only kept until the process is started. Repo fabfiles must still be at the commit the deployment
+    was frozen with, deployments are refused once the checkout has moved on.
+    """
+
+    if deployment.fabfile_commit:
+        commit = get_fabfile_commit(deployment.stage.project, deployment.fabfile_path)
+
+        if commit != deployment.fabfile_commit:
+            raise RuntimeError('The fabfile repo moved from commit {} to {} since this deployment was requested, '
+                               'start a new one'.format(deployment.fabfile_commit, commit))
+
+    env = os.environ.copy()
+    for name, value in json.loads(deployment.secrets or '{}').iteritems():
+        env[name.encode('utf-8')] = value.encode('utf-8')
+
+    process = subprocess.Popen(deployment.command, env=env, shell=True, **kwargs)
+
+    deployment.secrets = None
+    deployment.pid = process.pid
+    # Not the status, the deployment may have been aborted in the meantime
+    deployment.save(update_fields=['secrets', 'pid'])
+
+    return process
+
+
+def read_process_output(process, timeout=1):
+    """
+    Yield the output of a process as it comes, until it exits.
+
+    Waiting for output is cooperative under gevent, other greenlets run in the meantime. An empty string is yielded
+    every timeout seconds without output, and the process is checked then too, as children it left behind can keep
+    its stdout open after it exits.
+    """
+
+    fd = process.stdout.fileno()
+
+    while True:
+        try:
+            wait_read(fd, timeout=timeout)
+        except socket.timeout:
+            if process.poll() is not None:
+                break
+
+            yield ''
+            continue
+
+        output = os.read(fd, 4096)
+        if not output:
+            break
+
+        yield output
+
+    process.wait()
+
+
+class DeploymentLogWriter(object):
+    """
+    Appends the output of a deployment as DeploymentLogChunks.
+
+    Output is buffered and written as one chunk once max_delay seconds have passed since the last chunk, or max_size
+    characters are waiting, so a deploy makes a handful of small inserts instead of rewriting its whole output.
+
+    Bytes are decoded as UTF-8 as they come, a character split between two reads is only buffered once it's whole.
+    Call close() once the output has ended.
+    """
+
+    def __init__(self, deployment, max_delay=1, max_size=64 * 1024):
+        self.deployment = deployment
+        self.max_delay = max_delay
+        self.max_size = max_size
+
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.buffer = []
+        self.buffered_size = 0
+        self.last_flush = time.time()
+        self.sequence = deployment.log_chunks.aggregate(last=Max('sequence'))['last'] or 0
+
+    def write(self, text):
+        """Buffer some output. Writing an empty string only flushes the buffer if it's due."""
+
+        if isinstance(text, bytes):
+            text = self.decoder.decode(text)
+
+        if text:
+            self.buffer.append(text)
+            self.buffered_size += len(text)
+
+        if self.buffered_size >= self.max_size or time.time() - self.last_flush >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+
+        if not self.buffer:
+            return
+
+        self.sequence += 1
+        DeploymentLogChunk.objects.create(deployment=self.deployment, sequence=self.sequence, text=''.join(self.buffer))
+
+        self.buffer = []
+        self.buffered_size = 0
+        self.deployment.__dict__.pop('_output', None)
+
+    def close(self):
+        """Flush everything, including the bytes of a character the output ended in the middle of"""
+
+        self.write(self.decoder.decode(b'', final=True))
+        self.flush()
+
+
+def get_deployment_log_token(deployment):
+    """A token that lets whoever has it read the output of a deployment without logging in, see DeploymentLog"""
+
+    return signing.dumps(deployment.pk, salt=DEPLOYMENT_LOG_TOKEN_SALT)
+
+
+def check_deployment_log_token(deployment_pk, token):
+    """Whether token was made by get_deployment_log_token for the deployment, less than HOOK_OUTPUT_URL_MAX_AGE ago"""
+
+    if not token:
+        return False
+
+    try:
+        signed_pk = signing.loads(token, salt=DEPLOYMENT_LOG_TOKEN_SALT, max_age=settings.HOOK_OUTPUT_URL_MAX_AGE)
+    except signing.BadSignature:
+        return False
+
+    return str(signed_pk) == str(deployment_pk)
+
+
+def archive_deployment_output(deployment):
+    """
+    Compress the output of a finished deployment into its DeploymentLogArchive, and delete the uncompressed copies
+    (log chunks and legacy output). Returns the archive, None if the deployment has no output.
+    """
+
+    output = force_bytes(deployment.output)
+    if not output:
+        return None
+
+    data = zlib.compress(output)
+
+    with transaction.atomic():
+        archive, created = DeploymentLogArchive.objects.update_or_create(
+            deployment=deployment,
+            defaults={'data': data, 'size': len(output), 'compressed_size': len(data)}
+        )
+
+        deployment.log_chunks.all().delete()
+
+        if deployment.legacy_output is not None:
+            Deployment.objects.filter(pk=deployment.pk).update(legacy_output=None)
+            deployment.legacy_output = None
+
+    return archive
+
+
+def finish_deployment(deployment):
+    """
+    Save the final status of a deployment, send deployment_finished in the same transaction and archive its output.
+    Secrets a deployment that never started still has are forgotten.
+
+    Receivers that fail are logged, they can't undo the status: should the transaction fail because of them, the
+    status is saved again on its own. Receivers are expected to write in a savepoint of their own, and to leave
+    anything slow or talking to the network to the callable they return, which is called after the commit.
+    """
+
+    responses = []
+    deployment.secrets = None
+
+    try:
+        with transaction.atomic():
+            deployment.save()
+            responses = deployment_finished.send_robust(deployment, deployment_id=deployment.pk)
+    except Exception:
+        logger.exception('Could not commit what deployment_finished receivers did for deployment %s', deployment.pk)
+        responses = []
+        deployment.save()
+
+    # The receivers' work after the commit
+    for receiver, response in responses:
+        try:
+            if isinstance(response, Exception):
+                raise response
+            elif callable(response):
+                response()
+        except Exception:
+            logger.exception('deployment_finished receiver %r failed for deployment %s', receiver, deployment.pk)
+
+    archive_deployment_output(deployment)
+
+
+def get_deployment_stats_day(deployment):
+    """The (UTC) day a deployment is counted on in the DeploymentStats"""
+
+    day = deployment.date_created
+    if timezone.is_aware(day):
+        day = timezone.localtime(day, timezone.utc)
+
+    return day.date()
+
+
+def record_deployment_stats(deployment):
+    """Count a finished deployment in the DeploymentStats of its stage, day and status"""
+
+    if deployment.status not in Deployment.FINISHED_STATUSES or deployment.date_deleted:
+        return
+
+    stats, created = DeploymentStats.objects.get_or_create(
+        stage_id=deployment.stage_id,
+        day=get_deployment_stats_day(deployment),
+        status=deployment.status,
+        defaults={'project_id': deployment.stage.project_id, 'count': 1}
+    )
+
+    if not created:
+        DeploymentStats.objects.filter(pk=stats.pk).update(count=F('count') + 1)
+
+
+def forget_deployment_stats(deployment, status=None):
+    """
+    Take a finished deployment that is being deleted back out of the DeploymentStats. It's counted with status, its
+    current one by default.
+    """
+
+    status = status or deployment.status
+    if status not in Deployment.FINISHED_STATUSES:
+        return
+
+    DeploymentStats.objects.filter(
+        stage_id=deployment.stage_id,
+        day=get_deployment_stats_day(deployment),
+        status=status,
+        count__gt=0
+    ).update(count=F('count') - 1)
+
+
+def rebuild_deployment_stats():
+    """Recount all DeploymentStats from the deployments. Returns the number of deployments counted."""
+
+    rows = Deployment.objects.filter(status__in=Deployment.FINISHED_STATUSES, date_deleted__isnull=True)\
+        .count_by_day('stage', 'stage__project', 'status')
+
+    with transaction.atomic():
+        DeploymentStats.objects.all().delete()
+        DeploymentStats.objects.bulk_create([
+            DeploymentStats(project_id=row['stage__project'], stage_id=row['stage'], day=row['day'],
+                            status=row['status'], count=row['count'])
+            for row in rows
+        ], batch_size=500)
+
+    return sum(row['count'] for row in rows)
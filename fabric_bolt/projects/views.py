@@ -7,8 +7,9 @@ import subprocess
 import sys
 from copy import deepcopy
 
-from django.http import HttpResponseRedirect, StreamingHttpResponse
-from django.db.models.aggregates import Count
+from django.contrib.auth.views import redirect_to_login
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.db.models.aggregates import Count, Sum
 from django.contrib import messages
 from django.views.generic import CreateView, UpdateView, DetailView, DeleteView, RedirectView, View
 from django.core.urlresolvers import reverse_lazy, reverse
@@ -21,10 +22,12 @@ from django_tables2 import RequestConfig, SingleTableView
 
 from fabric_bolt.core.mixins.views import MultipleGroupRequiredMixin
 from fabric_bolt.hosts.models import Host
+from fabric_bolt.launch_window.schedule import launch_window_schedule
 from fabric_bolt.projects import forms, tables, models
-from fabric_bolt.projects.util import get_fabric_tasks, build_command, get_task_details
+from fabric_bolt.projects.util import get_fabric_tasks, get_task_details, freeze_deployment, \
+    start_deployment_process, DeploymentLogWriter, finish_deployment, check_deployment_log_token, UnknownTaskError
 from fabric_bolt.web_hooks.tables import HookTable
-from fabric_bolt.projects.signals import deployment_finished
+from fabric_bolt.projects.executor import queue_enabled, follow_deployment_output
 from copy import deepcopy
 
 
@@ -69,7 +72,7 @@ class ProjectList(SingleTableView):
 
     table_class = tables.ProjectTable
     model = models.Project
-    queryset = models.Project.active_records.all()
+    queryset = models.Project.active_records.annotate(deployment_count=Sum('deploymentstats__count'))
 
 
 class ProjectCreate(CreateView):
@@ -111,7 +114,8 @@ class ProjectCopy(MultipleGroupRequiredMixin, CreateView):
                             'description': self.copy_object.description,
                             'use_repo_fabfile': self.copy_object.use_repo_fabfile,
                             'fabfile_requirements': self.copy_object.fabfile_requirements,
-                            'repo_url': self.copy_object.repo_url})
+                            'repo_url': self.copy_object.repo_url,
+                            'repo_fabfile_path': self.copy_object.repo_fabfile_path})
         return initial
 
     def get(self, request, *args, **kwargs):
@@ -197,7 +201,7 @@ class ProjectDetail(DetailView):
         RequestConfig(self.request).configure(stage_table)
         context['stage_table'] = stage_table
 
-        deployment_table = tables.DeploymentTable(models.Deployment.objects.filter(stage__in=stages).select_related('stage', 'task'), prefix='deploy_')
+        deployment_table = tables.DeploymentTable(models.Deployment.objects.filter(stage__in=stages).for_table(), prefix='deploy_')
         RequestConfig(self.request).configure(deployment_table)
         context['deployment_table'] = deployment_table
 
@@ -333,7 +337,11 @@ class ProjectDeploymentList(ProjectSubPageMixin, SingleTableView):
     model = models.Deployment
 
     def get_queryset(self):
-        return models.Deployment.objects.filter(stage__project=self.project).select_related('stage', 'task')
+        return models.Deployment.objects.filter(stage__project=self.project).for_table()
+
+    def get_table_pagination(self):
+        # Deep history pages cost the same as the first one
+        return {'cursor_pagination': True, 'cursor': self.request.GET.get('cursor')}
 
 
 class DeploymentCreate(MultipleGroupRequiredMixin, CreateView):
@@ -357,6 +365,15 @@ class DeploymentCreate(MultipleGroupRequiredMixin, CreateView):
 
         self.task_name, self.task_description, self.task_args = task_details
 
+        if getattr(settings, 'LAUNCH_WINDOWS_REQUIRED', False):
+            launch_windows = launch_window_schedule.get_status()
+
+            if launch_windows.has_windows and not launch_windows.is_open:
+                messages.error(self.request, 'Deployments can only be made during a launch window.')
+                return HttpResponseRedirect(
+                    reverse('projects_stage_view', kwargs={'project_id': self.stage.project_id, 'pk': self.stage.pk})
+                )
+
         return super(DeploymentCreate, self).dispatch(request, *args, **kwargs)
 
     def get_form(self, form_class):
@@ -435,14 +452,29 @@ class DeploymentCreate(MultipleGroupRequiredMixin, CreateView):
             self.object.task.save()
 
         self.object.user = self.request.user
-        self.object.save()
 
         configuration_values = {}
         for key, value in form.cleaned_data.iteritems():
             if key.startswith('configuration_value_for_'):
                 configuration_values[key.replace('configuration_value_for_', '')] = value
 
-        self.request.session['configuration_values'] = configuration_values
+        if queue_enabled():
+            # Nobody is attached to a worker's deployment to answer prompts
+            self.object.status = self.object.QUEUED
+            abort_on_prompts = True
+        else:
+            # Socket.io deployments are interactive, the user can answer prompts
+            abort_on_prompts = not getattr(settings, 'SOCKETIO_ENABLED', False)
+
+        try:
+            freeze_deployment(self.object, configuration_values, abort_on_prompts)
+        except UnknownTaskError as e:
+            messages.error(self.request, unicode(e))
+            return HttpResponseRedirect(
+                reverse('projects_stage_view', kwargs={'project_id': self.stage.project_id, 'pk': self.stage.pk})
+            )
+
+        self.object.save()
 
         return super(DeploymentCreate, self).form_valid(form)
 
@@ -468,6 +500,18 @@ class DeploymentDetail(StageSubPageMixin, DetailView):
     """
     model = models.Deployment
 
+    def get_context_data(self, **kwargs):
+        context = super(DeploymentDetail, self).get_context_data(**kwargs)
+
+        # Followers of a worker's deployment get its output from the start
+        context['follow_output'] = queue_enabled() and self.object.in_progress
+
+        # What DeploymentOutputStream serves: a queued or running deployment to follow, or a pending one to run
+        context['stream_output'] = context['follow_output'] or \
+            (not queue_enabled() and self.object.status == self.object.PENDING)
+
+        return context
+
     def get_template_names(self):
         if getattr(settings, 'SOCKETIO_ENABLED', False):
             return ['projects/deployment_detail_socketio.html']
@@ -475,30 +519,45 @@ class DeploymentDetail(StageSubPageMixin, DetailView):
             return ['projects/deployment_detail.html']
 
 
+class DeploymentLog(StageSubPageMixin, DetailView):
+    """
+    The full output of a deployment, as plain text. Web hook payloads only carry the end of it, and a link here with a
+    token to get the rest without logging in.
+    """
+    model = models.Deployment
+
+    def dispatch(self, request, *args, **kwargs):
+        # Public as far as stronghold is concerned
+        token = request.GET.get('token')
+
+        if not request.user.is_authenticated() and not check_deployment_log_token(kwargs['pk'], token):
+            return redirect_to_login(request.get_full_path())
+
+        return super(DeploymentLog, self).dispatch(request, *args, **kwargs)
+
+    def get_queryset(self):
+        return models.Deployment.objects.filter(stage=self.stage)
+
+    def render_to_response(self, context, **response_kwargs):
+        return HttpResponse(self.object.output or '', content_type='text/plain; charset=utf-8')
+
+
 class DeploymentOutputStream(StageSubPageMixin, View):
     """
     Deployment view does the heavy lifting of calling Fabric Task for a Project Stage
     """
 
     def output_stream_generator(self):
-        if get_task_details(self.project, self.object.task.name) is None:
-            return
-
         try:
-            process = subprocess.Popen(
-                build_command(self.object, self.request.session),
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                shell=True
-            )
+            process = start_deployment_process(self.object, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
-            all_output = ''
+            log = DeploymentLogWriter(self.object)
             while True:
                 nextline = process.stdout.readline()
                 if nextline == '' and process.poll() != None:
                     break
 
-                all_output += nextline
+                log.write(nextline)
 
                 yield '<span style="color:rgb(200, 200, 200);font-size: 14px;font-family: \'Helvetica Neue\', Helvetica, Arial, sans-serif;">{} </span><br /> {}'.format(nextline, ' '*1024)
                 sys.stdout.flush()
@@ -507,17 +566,32 @@ class DeploymentOutputStream(StageSubPageMixin, View):
 
             yield '<span id="finished" style="display:none;">{}</span> {}'.format(self.object.status, ' '*1024)
 
-            self.object.output = all_output
-            self.object.save()
-
-            deployment_finished.send(self.object, deployment_id=self.object.pk)
+            log.close()
+            finish_deployment(self.object)
 
         except Exception as e:
             message = "An error occurred: " + e.message
             yield '<span style="color:rgb(200, 200, 200);font-size: 14px;font-family: \'Helvetica Neue\', Helvetica, Arial, sans-serif;">{} </span><br /> {}'.format(message, ' '*1024)
             yield '<span id="finished" style="display:none;">failed</span> {}'.format('*1024')
 
+    def follow_stream_generator(self):
+        for output in follow_deployment_output(self.object):
+            for line in output.splitlines(True):
+                yield '<span style="color:rgb(200, 200, 200);font-size: 14px;font-family: \'Helvetica Neue\', Helvetica, Arial, sans-serif;">{} </span><br /> {}'.format(line, ' '*1024)
+
+        yield '<span id="finished" style="display:none;">{}</span> {}'.format(self.object.status, ' '*1024)
+
     def get(self, request, *args, **kwargs):
+        if queue_enabled():
+            # A worker runs it, we only follow its output
+            self.object = get_object_or_404(
+                models.Deployment,
+                stage=self.stage,
+                pk=int(kwargs['pk']),
+                status__in=[models.Deployment.QUEUED, models.Deployment.RUNNING]
+            )
+            return StreamingHttpResponse(self.follow_stream_generator())
+
         self.object = get_object_or_404(
             models.Deployment,
             stage=self.stage,
@@ -642,7 +716,11 @@ class StageDeploymentList(StageSubPageMixin, SingleTableView):
     template_name_suffix = '_stage_list'
 
     def get_queryset(self):
-        return models.Deployment.objects.filter(stage=self.stage).select_related('stage', 'task')
+        return models.Deployment.objects.filter(stage=self.stage).for_table()
+
+    def get_table_pagination(self):
+        # Deep history pages cost the same as the first one
+        return {'cursor_pagination': True, 'cursor': self.request.GET.get('cursor')}
 
     def get_table(self, **kwargs):
         table = super(StageDeploymentList, self).get_table(**kwargs)
@@ -706,8 +784,9 @@ class ProjectInvalidateCache(RedirectView):
     def get(self, request, *args, **kwargs):
         self.project_id = kwargs.get('pk')
 
-        cache.delete_many(['project_{}_fabfile_tasks'.format(self.project_id),
-                           'project_{}_fabfile_path'.format(self.project_id)])
+        # Task lists are cached by fabfile digest, so dropping the checkout makes the next request pull the repo
+        # and pick up any changed tasks.
+        cache.delete('project_{}_fabfile_path'.format(self.project_id))
 
         messages.info(request, "Tasks cache invalidated.")
 
@@ -1,5 +1,6 @@
 from django.contrib import admin
 
-from .models import Hook
+from .models import Hook, HookDelivery
 
 admin.site.register(Hook)
+admin.site.register(HookDelivery)
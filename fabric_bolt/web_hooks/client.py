@@ -9,36 +9,49 @@
 # AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
 # PERFORMANCE OF THIS SOFTWARE.
 
+import logging
 import threading
-import collections
+import urlparse
+import Queue
 
 import requests
+from requests.adapters import HTTPAdapter
 
+from django.db import close_old_connections
 
-class FlushThread(threading.Thread):
-    def __init__(self, client):
-        threading.Thread.__init__(self)
-        self.client = client
-
-    def run(self):
-        self.client.sync_flush()
+logger = logging.getLogger(__name__)
 
 
 class Client(object):
     """
-    Manages a simple pool of threads to flush the queue of requests.
+    Sends queued requests (or runs other jobs, see submit) with a pool of worker threads that live as long as the
+    process.
+
+    Requests to the same host share a requests.Session, so their connections are kept alive and reused. With
+    num_threads=0 everything is done right away in the calling thread.
     """
-    def __init__(self, num_threads=3):
-        self.queue = collections.deque()
+    def __init__(self, num_threads=3, timeout=None):
+        self.queue = Queue.Queue()
 
-        self.flush_lock = threading.Lock()
+        self.lock = threading.Lock()
         self.num_threads = num_threads
-        self.flush_threads = [FlushThread(self) for _ in range(self.num_threads)]
+        self.timeout = timeout
+        self.workers = []
+        self.sessions = {}
         self.total_sent = 0
 
     def enqueue(self, method, *args, **kwargs):
-        self.queue.append((method, args, kwargs))
-        self.refresh_threads()
+        self.submit(self.send, method, args, kwargs)
+
+    def submit(self, func, *args, **kwargs):
+        """Have one of the worker threads call func, or call it right away if there are no threads"""
+
+        if not self.num_threads:
+            func(*args, **kwargs)
+            return
+
+        self.queue.put((func, args, kwargs))
+        self.start_workers()
 
     def get(self, *args, **kwargs):
         self.enqueue('get', *args, **kwargs)
@@ -52,17 +65,77 @@ class Client(object):
     def delete(self, *args, **kwargs):
         self.enqueue('delete', *args, **kwargs)
 
-    def refresh_threads(self):
-        with self.flush_lock:
-            # refresh if there are jobs to do and no threads are alive
-            if len(self.queue) > 0:
-                to_refresh = [index for index, thread in enumerate(self.flush_threads) if not thread.is_alive()]
-                for index in to_refresh:
-                    self.flush_threads[index] = FlushThread(self)
-                    self.flush_threads[index].start()
+    def start_workers(self):
+        with self.lock:
+            # Workers only stop with the process, this also restarts them in processes forked from this one
+            self.workers = [worker for worker in self.workers if worker.is_alive()]
 
-    def sync_flush(self):
-        while len(self.queue) > 0:
-            method, args, kwargs = self.queue.pop()
-            getattr(requests, method)(*args, **kwargs)
+            while len(self.workers) < self.num_threads:
+                worker = threading.Thread(target=self.work, name='web-hook-client')
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def get_session(self, url):
+        scheme, host = urlparse.urlsplit(url)[:2]
+
+        with self.lock:
+            session = self.sessions.get((scheme, host))
+
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(self.num_threads, 1))
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[scheme, host] = session
+
+        return session
+
+    def send(self, method, args, kwargs):
+        url = kwargs.get('url') or args[0]
+        kwargs.setdefault('timeout', self.timeout)
+
+        try:
+            response = getattr(self.get_session(url), method)(*args, **kwargs)
+        except requests.RequestException as e:
+            logger.warning('Web hook %s %s failed: %s', method.upper(), url, e)
+            return None
+
+        with self.lock:
             self.total_sent += 1
+
+        return response
+
+    def work(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+
+            # Jobs use the ORM, and the thread's database connection outlives any request. Like at the start and end
+            # of a request, it's closed if it's broken or too old.
+            close_old_connections()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception('Web hook job %s failed', getattr(func, '__name__', func))
+            finally:
+                close_old_connections()
+                self.queue.task_done()
+
+    def sync_flush(self):
+        """Run everything queued from the calling thread"""
+
+        while True:
+            try:
+                func, args, kwargs = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                func(*args, **kwargs)
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        """Wait for everything queued to be sent"""
+
+        self.queue.join()
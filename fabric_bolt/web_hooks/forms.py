@@ -18,6 +18,9 @@ class HookCreateForm(forms.ModelForm):
         fields = [
             'project',
             'url',
+            'batch_window',
+            'batch_size',
+            'output_tail',
         ]
 
     def __init__(self, *args, **kwargs):
@@ -25,6 +28,9 @@ class HookCreateForm(forms.ModelForm):
         self.helper.layout = Layout(
             'project',
             'url',
+            'batch_window',
+            'batch_size',
+            'output_tail',
 
             ButtonHolder(
                 Submit('submit', '%s Hook' % self.button_prefix, css_class='button')
@@ -56,6 +62,9 @@ class HookUpdateForm(HookCreateForm):
         self.helper.layout = Layout(
             'project',
             'url',
+            'batch_window',
+            'batch_size',
+            'output_tail',
 
             ButtonHolder(
                 Submit('submit', '%s Hook' % self.button_prefix, css_class='button'),
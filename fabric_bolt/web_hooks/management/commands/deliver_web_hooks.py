@@ -0,0 +1,45 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from fabric_bolt.web_hooks.outbox import deliver_due, prune_deliveries
+
+
+class Command(BaseCommand):
+    help = 'Deliver the web hooks waiting in the outbox, retrying failed deliveries with exponential backoff until ' \
+           'they succeed or HOOK_MAX_ATTEMPTS is reached. Deliveries older than HOOK_DELIVERY_RETENTION are deleted.'
+
+    # Seconds between deletions of expired deliveries
+    prune_interval = 60 * 60
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Deliver what is due and exit, instead of checking the outbox forever.'),
+        make_option('--poll-interval', type='float', dest='poll_interval', default=1,
+                    help='Seconds to wait for deliveries to become due.'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = 100
+        last_pruned = None
+
+        try:
+            while True:
+                # Reconnect if the database went away since the last round
+                close_old_connections()
+
+                if last_pruned is None or time.time() - last_pruned >= self.prune_interval:
+                    prune_deliveries()
+                    last_pruned = time.time()
+
+                due = deliver_due(limit=batch_size)
+
+                if options['once'] and due < batch_size:
+                    break
+
+                if due < batch_size:
+                    time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
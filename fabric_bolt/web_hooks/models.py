@@ -3,7 +3,7 @@ from django.db import models
 
 from fabric_bolt.core.mixins.models import TrackingFields
 
-from fabric_bolt.projects.models import Project
+from fabric_bolt.projects.models import Project, Deployment
 
 from .managers import HookManager
 
@@ -15,6 +15,18 @@ class Hook(TrackingFields):
 
     url = models.URLField()
 
+    # Targets that get a lot of deployments can have them POSTed together, as a JSON array of payloads
+    batch_window = models.PositiveIntegerField(null=True, blank=True, verbose_name='Batch window (seconds)',
+                                               help_text='Collect deployments for this long and POST them together. '
+                                                         'Leave empty to POST each deployment right away.')
+    batch_size = models.PositiveIntegerField(default=100, help_text='Most deployments POSTed together.')
+
+    # Deployment logs can be megabytes, payloads can link to the full log instead
+    output_tail = models.PositiveIntegerField(null=True, blank=True,
+                                              verbose_name='Output tail (characters)',
+                                              help_text='Include only this many characters from the end of the '
+                                                        'deployment output, e.g. 10000. Leave empty for all of it.')
+
     # Custom manager to allow us to look up the proper hooks
     objects = HookManager()
 
@@ -27,3 +39,53 @@ class Hook(TrackingFields):
             return reverse('index')
 
         return reverse('projects_project_view', args=(self.project.pk,))
+
+
+class HookDelivery(models.Model):
+    """A web hook POST in the outbox, kept with its attempts after it's been delivered or given up on"""
+
+    PENDING = 'pending'
+    DELIVERED = 'delivered'
+    DEAD = 'dead'
+
+    STATUS = [(PENDING, 'Pending'), (DELIVERED, 'Delivered'), (DEAD, 'Given up')]
+
+    hook = models.ForeignKey(Hook, null=True, blank=True, on_delete=models.SET_NULL, related_name='deliveries')
+    deployment = models.ForeignKey(Deployment, null=True, blank=True, on_delete=models.SET_NULL)
+    url = models.URLField()
+    payload = models.TextField(help_text='JSON encoded')
+
+    status = models.CharField(choices=STATUS, max_length=10, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(null=True, blank=True)
+
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_delivered = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-date_created']
+        # The outbox worker looks for pending deliveries that are due
+        index_together = [['status', 'next_attempt']]
+
+    def __unicode__(self):
+        return u'{} to {}'.format(self.get_status_display(), self.url)
+
+    @property
+    def latency(self):
+        """Seconds from queueing to delivery"""
+
+        if self.date_delivered:
+            return (self.date_delivered - self.date_created).total_seconds()
+
+
+class HookDeliveryAttempt(models.Model):
+    """One try at POSTing a HookDelivery"""
+
+    delivery = models.ForeignKey(HookDelivery, related_name='attempt_set')
+    date_created = models.DateTimeField(auto_now_add=True)
+    duration = models.FloatField(help_text='Seconds')
+    status_code = models.PositiveIntegerField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['date_created']
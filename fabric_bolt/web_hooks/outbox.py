@@ -0,0 +1,247 @@
+"""
+The web hook outbox: deliveries are stored in the transaction that finishes a deployment, then POSTed until they
+succeed, with exponential backoff between attempts. Deliveries that keep failing are given up on (dead lettered).
+Delivered and dead lettered ones are kept for HOOK_DELIVERY_RETENTION.
+"""
+
+import json
+import time
+import logging
+import threading
+import urlparse
+from datetime import timedelta
+
+import requests
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Max
+from django.utils import timezone
+
+from fabric_bolt.web_hooks.models import HookDelivery, HookDeliveryAttempt
+from fabric_bolt.web_hooks.utils import client
+
+logger = logging.getLogger(__name__)
+
+# How long a delivery is reserved for the worker that is trying it. Should that worker die, others retry it after.
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+
+class RateLimiter(object):
+    """Spaces requests to the same host at least 1 / rate seconds apart, within this process"""
+
+    def __init__(self, rate, max_wait=1):
+        self.rate = rate
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.next_allowed = {}
+
+    def acquire(self, url):
+        """Wait for the host's turn. Returns False, without waiting, if that's more than max_wait away."""
+
+        if not self.rate:
+            return True
+
+        host = urlparse.urlsplit(url).netloc
+
+        with self.lock:
+            now = time.time()
+            allowed = max(now, self.next_allowed.get(host, 0))
+
+            if allowed - now > self.max_wait:
+                return False
+
+            self.next_allowed[host] = allowed + 1.0 / self.rate
+
+        time.sleep(allowed - now)
+        return True
+
+
+rate_limiter = RateLimiter(getattr(settings, 'HOOK_RATE_LIMIT', 0))
+
+
+def encode_payload(payload):
+    return json.dumps(payload, cls=DjangoJSONEncoder)
+
+
+def queue_delivery(hook, deployment, payload):
+    """Add a delivery of payload to hook to the outbox"""
+
+    return HookDelivery.objects.create(hook=hook, deployment=deployment, url=hook.url,
+                                       payload=encode_payload(payload), next_attempt=timezone.now())
+
+
+def queue_deliveries(deployment, hook_payloads):
+    """Add deliveries of a deployment to the outbox, given (hook, JSON encoded payload) pairs, returns them"""
+
+    now = timezone.now()
+    last_pk = HookDelivery.objects.filter(deployment=deployment).aggregate(pk=Max('pk'))['pk'] or 0
+
+    HookDelivery.objects.bulk_create([
+        HookDelivery(hook=hook, deployment=deployment, url=hook.url, payload=encoded_payload,
+                     next_attempt=now + timedelta(seconds=hook.batch_window or 0))
+        for hook, encoded_payload in hook_payloads
+    ])
+
+    # bulk_create doesn't set the primary keys
+    return list(HookDelivery.objects.filter(deployment=deployment, pk__gt=last_pk).order_by('pk'))
+
+
+def send_deliveries(deliveries):
+    """
+    Make the first attempts at some deliveries right away, with the web hook client's threads. Deliveries to hooks
+    that batch them are left to the deliver_web_hooks command.
+    """
+
+    now = timezone.now()
+
+    for delivery in deliveries:
+        if delivery.next_attempt <= now:
+            client.submit(attempt_delivery, delivery)
+
+
+def get_retry_delay(attempts):
+    delay = getattr(settings, 'HOOK_RETRY_DELAY', 30) * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, getattr(settings, 'HOOK_RETRY_MAX_DELAY', 60 * 60)))
+
+
+def claim(delivery, due_by):
+    """Reserve a pending delivery due by due_by for this worker, returns whether it got it"""
+
+    return HookDelivery.objects\
+        .filter(pk=delivery.pk, status=HookDelivery.PENDING, next_attempt__lte=due_by)\
+        .update(next_attempt=timezone.now() + CLAIM_TIMEOUT)
+
+
+def post(url, body):
+    """POST some JSON, returns the status code (None if there's no response), the error and how long it took"""
+
+    status_code = error = None
+    start = time.time()
+
+    try:
+        response = client.get_session(url).post(url, data=body, headers={'Content-Type': 'application/json'},
+                                                timeout=client.timeout)
+        status_code = response.status_code
+    except requests.RequestException as e:
+        error = str(e)
+
+    return status_code, error, time.time() - start
+
+
+def record_attempt(deliveries, status_code, error, duration):
+    """Note that deliveries were POSTed (together), and when to try them again if that failed"""
+
+    HookDeliveryAttempt.objects.bulk_create([
+        HookDeliveryAttempt(delivery=delivery, duration=duration, status_code=status_code, error=error)
+        for delivery in deliveries
+    ])
+
+    now = timezone.now()
+
+    for delivery in deliveries:
+        delivery.attempts += 1
+
+        if status_code is not None and 200 <= status_code < 300:
+            delivery.status = HookDelivery.DELIVERED
+            delivery.date_delivered = now
+            delivery.next_attempt = None
+        elif status_code == 410 or delivery.attempts >= getattr(settings, 'HOOK_MAX_ATTEMPTS', 8):
+            # 410 Gone: the target tells us not to bother
+            logger.warning('Giving up on web hook delivery %s to %s after %s attempts', delivery.pk, delivery.url,
+                           delivery.attempts)
+            delivery.status = HookDelivery.DEAD
+            delivery.next_attempt = None
+        else:
+            delivery.next_attempt = now + get_retry_delay(delivery.attempts)
+
+        delivery.save()
+
+
+def attempt_delivery(delivery):
+    """
+    POST a pending delivery once, and record how that went. Returns False if it wasn't tried, because it isn't due,
+    another worker is on it or its host has been sent too much.
+    """
+
+    if not rate_limiter.acquire(delivery.url):
+        return False
+
+    if not claim(delivery, timezone.now()):
+        return False
+
+    record_attempt([delivery], *post(delivery.url, delivery.payload))
+    return True
+
+
+def attempt_batch(hook):
+    """
+    POST the pending deliveries of a batching hook that are due, plus those queued within its batch window after
+    them, as one JSON array. Returns False if there was nothing to send or the hook's host has been sent too much.
+    """
+
+    if not rate_limiter.acquire(hook.url):
+        return False
+
+    due_by = timezone.now() + timedelta(seconds=hook.batch_window or 0)
+    candidates = HookDelivery.objects\
+        .filter(hook=hook, status=HookDelivery.PENDING, next_attempt__lte=due_by)\
+        .order_by('next_attempt', 'pk')[:hook.batch_size]
+
+    deliveries = [delivery for delivery in candidates if claim(delivery, due_by)]
+
+    if not deliveries:
+        return False
+
+    # The payloads are JSON already
+    body = u'[{}]'.format(u','.join(delivery.payload for delivery in deliveries))
+
+    record_attempt(deliveries, *post(hook.url, body))
+    return True
+
+
+def deliver_due(limit=100):
+    """Attempt the deliveries that are due with the web hook client's threads. Returns how many were due."""
+
+    due = list(HookDelivery.objects
+               .filter(status=HookDelivery.PENDING, next_attempt__lte=timezone.now())
+               .select_related('hook')
+               .order_by('next_attempt', 'pk')[:limit])
+
+    batched_hooks = set()
+
+    for delivery in due:
+        if delivery.hook and delivery.hook.batch_window:
+            if delivery.hook_id not in batched_hooks:
+                batched_hooks.add(delivery.hook_id)
+                client.submit(attempt_batch, delivery.hook)
+        else:
+            client.submit(attempt_delivery, delivery)
+
+    client.join()
+
+    return len(due)
+
+
+def prune_deliveries(batch_size=1000):
+    """
+    Delete the deliveries that were delivered or given up on and were queued more than HOOK_DELIVERY_RETENTION seconds
+    ago, with their attempts. Returns how many were deleted.
+    """
+
+    retention = getattr(settings, 'HOOK_DELIVERY_RETENTION', None)
+    if retention is None:
+        return 0
+
+    expired = HookDelivery.objects.filter(status__in=[HookDelivery.DELIVERED, HookDelivery.DEAD],
+                                          date_created__lt=timezone.now() - timedelta(seconds=retention))
+    deleted = 0
+
+    while True:
+        pks = list(expired.order_by().values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+
+        HookDeliveryAttempt.objects.filter(delivery__in=pks).delete()
+        HookDelivery.objects.filter(pk__in=pks).delete()
+        deleted += len(pks)
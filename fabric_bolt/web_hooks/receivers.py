@@ -1,6 +1,9 @@
+from django.conf import settings
+from django.db import transaction
 from django.dispatch import receiver
 
-from fabric_bolt.web_hooks.utils import deliver_hook, payload_generator
+from fabric_bolt.web_hooks.utils import deliver_hook, payload_generator, tail_output
+from fabric_bolt.web_hooks.outbox import encode_payload, queue_deliveries, send_deliveries
 from fabric_bolt.projects.signals import deployment_finished
 from fabric_bolt.projects.models import Deployment
 
@@ -9,15 +12,33 @@ from fabric_bolt.projects.models import Deployment
 def web_hook_receiver(sender, **kwargs):
     """Generic receiver for the web hook firing piece."""
 
-    deployment = Deployment.objects.get(pk=kwargs.get('deployment_id'))
+    # Everything the payload shows in one query, the payload is built once for all hooks
+    deployment = Deployment.objects.select_related('stage__project', 'task', 'user')\
+        .get(pk=kwargs.get('deployment_id'))
 
-    hooks = deployment.web_hooks
+    hooks = list(deployment.web_hooks)
 
     if not hooks:
         return
 
+    data = payload_generator(deployment)
+
+    # A custom deliverer takes care of delivering by itself, once the deployment is committed
+    if getattr(settings, 'HOOK_DELIVERER', None):
+        def deliver():
+            for hook in hooks:
+                deliver_hook(deployment, hook.url, tail_output(data, hook.output_tail))
+
+        return deliver
+
+    # Hooks only differ in how much of the output they get
+    encoded = {}
     for hook in hooks:
+        if hook.output_tail not in encoded:
+            encoded[hook.output_tail] = encode_payload(tail_output(data, hook.output_tail))
 
-        data = payload_generator(deployment)
+    with transaction.atomic():
+        deliveries = queue_deliveries(deployment, [(hook, encoded[hook.output_tail]) for hook in hooks])
 
-        deliver_hook(deployment, hook.url, data)
+    # Once the deliveries are committed
+    return lambda: send_deliveries(deliveries)
@@ -4,8 +4,23 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import json
+import time
+import socket
+from datetime import timedelta
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import mock
+import requests
+
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.core.management import call_command
+from django.utils import timezone
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, SimpleTestCase
 from django.contrib.auth import get_user_model
 from django.core.cache import cache
 
@@ -13,6 +28,12 @@ from model_mommy import mommy
 
 from fabric_bolt.projects import models
 from fabric_bolt.web_hooks import models as hook_models
+from fabric_bolt.projects.util import finish_deployment
+from fabric_bolt.projects.signals import deployment_finished
+from fabric_bolt.web_hooks.client import Client
+from fabric_bolt.web_hooks.receivers import web_hook_receiver
+from fabric_bolt.web_hooks.outbox import RateLimiter, queue_delivery, attempt_delivery, get_retry_delay, deliver_due, \
+    prune_deliveries
 
 User = get_user_model()
 
@@ -133,4 +154,347 @@ class BasicTests(TestCase):
     def test_project_web_hooks(self):
         project_hooks = hook_models.Hook.objects.filter(project=self.project)
 
-        self.assertEqual(1, project_hooks.count())
\ No newline at end of file
+        self.assertEqual(1, project_hooks.count())
+
+class StubHookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one go like real servers, not a packet per header line
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.received.append(body)
+
+        self.send_response(self.server.status_code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubHookServer(ThreadingMixIn, HTTPServer):
+    """Local web hook target that counts the connections and requests it gets"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHookHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.received = []
+        self.status_code = 200
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/hook/'.format(self.server_address[1])
+
+
+class ClientBenchmarkTests(SimpleTestCase):
+
+    REQUESTS = 300
+
+    def setUp(self):
+        self.server = StubHookServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, client):
+        start = time.time()
+        for i in range(self.REQUESTS):
+            client.post(url=self.server.url, data='{"id": %d}' % i, headers={'Content-Type': 'application/json'})
+        if isinstance(client, Client):
+            client.join()
+        return time.time() - start
+
+    def test_keep_alive(self):
+        # What deliveries used to do, a new connection for each of them
+        unpooled = self.post(requests)
+        self.assertEqual(self.server.connections, self.REQUESTS)
+
+        self.server.connections = 0
+        pooled = self.post(Client(num_threads=3, timeout=5))
+
+        self.assertEqual(len(self.server.received), self.REQUESTS * 2)
+        self.assertLessEqual(self.server.connections, 3)
+        self.assertLess(pooled, unpooled)
+
+    def test_failed_requests(self):
+        # Nothing listens on a port we just closed
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        closed_url = 'http://127.0.0.1:{}/hook/'.format(closed.getsockname()[1])
+        closed.close()
+
+        client = Client(num_threads=1, timeout=1)
+        client.post(url=closed_url, data='{}')
+        client.post(url=self.server.url, data='{}')
+        client.join()
+
+        self.assertEqual(client.total_sent, 1)
+        self.assertEqual(self.server.received, ['{}'])
+
+        # Worker threads don't hold on to broken database connections
+        with mock.patch('fabric_bolt.web_hooks.client.close_old_connections') as close_old_connections:
+            client.submit(lambda: None)
+            client.join()
+
+        self.assertEqual(close_old_connections.call_count, 2)
+
+        # Without threads requests are sent right away
+        client = Client(num_threads=0, timeout=1)
+        client.post(url=self.server.url, data='{}')
+        self.assertEqual(client.total_sent, 1)
+
+
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        self.server = StubHookServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        # Deliver from the test's thread, other threads can't see its transaction
+        patcher = mock.patch('fabric_bolt.web_hooks.outbox.client', Client(num_threads=0, timeout=5))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.deployment = mommy.make(models.Deployment, status=models.Deployment.SUCCESS)
+        self.hook = mommy.make(hook_models.Hook, project=self.deployment.stage.project, url=self.server.url)
+
+    def test_deployment_finished(self):
+        global_hook = mommy.make(hook_models.Hook, project=None, url=self.server.url + 'global/')
+
+        finish_deployment(self.deployment)
+
+        deliveries = hook_models.HookDelivery.objects.order_by('pk')
+        self.assertEqual([delivery.hook for delivery in deliveries], [self.hook, global_hook])
+
+        for delivery in deliveries:
+            self.assertEqual(delivery.status, hook_models.HookDelivery.DELIVERED)
+            self.assertEqual(delivery.attempts, 1)
+            self.assertIsNotNone(delivery.latency)
+            self.assertEqual(delivery.attempt_set.get().status_code, 200)
+
+        self.assertEqual([json.loads(body)['id'] for body in self.server.received], [self.deployment.pk] * 2)
+
+        user = User.objects.create_superuser(email='myemail@test.com', password='mypassword')
+        self.client.login(email=user.email, password='mypassword')
+        result = self.client.get(reverse('hooks_hook_view', args=(self.hook.pk,)))
+        self.assertContains(result, 'HTTP 200', count=1)
+
+    def test_failing_receivers(self):
+        def broken_receiver(sender, **kwargs):
+            raise ValueError('broken')
+
+        deployment_finished.connect(broken_receiver, dispatch_uid='broken_receiver')
+        self.addCleanup(deployment_finished.disconnect, dispatch_uid='broken_receiver')
+
+        deployment = mommy.make(models.Deployment, stage=self.deployment.stage, status=models.Deployment.PENDING,
+                                pid=1234)
+        deployment.status = models.Deployment.FAILED
+        deployment.pid = None
+
+        with mock.patch('fabric_bolt.web_hooks.receivers.payload_generator', side_effect=ValueError('broken')):
+            finish_deployment(deployment)
+
+        deployment = models.Deployment.objects.get(pk=deployment.pk)
+        self.assertEqual((deployment.status, deployment.pid), (models.Deployment.FAILED, None))
+        self.assertEqual(deployment.stage.project.get_deployment_count(), 1)
+        self.assertFalse(hook_models.HookDelivery.objects.exists())
+
+    def test_custom_deliverer(self):
+        with mock.patch('fabric_bolt.web_hooks.receivers.deliver_hook') as deliver_hook:
+            with self.settings(HOOK_DELIVERER='path.to.deliverer'):
+                deliver = web_hook_receiver(None, deployment_id=self.deployment.pk)
+
+            # Not from inside the deployment's transaction
+            self.assertFalse(deliver_hook.called)
+
+            deliver()
+            self.assertEqual(deliver_hook.call_count, 1)
+
+        self.assertFalse(hook_models.HookDelivery.objects.exists())
+
+    def test_payload_built_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            web_hook_receiver(None, deployment_id=self.deployment.pk)
+
+        for i in range(5):
+            mommy.make(hook_models.Hook, project=self.deployment.stage.project, url=self.server.url + str(i))
+
+        hook_models.HookDelivery.objects.all().delete()
+
+        with self.assertNumQueries(len(queries)):
+            web_hook_receiver(None, deployment_id=self.deployment.pk)
+
+        payloads = set(hook_models.HookDelivery.objects.values_list('payload', flat=True))
+        self.assertEqual(len(payloads), 1)
+        self.assertEqual(json.loads(payloads.pop())['stage']['name'], self.deployment.stage.name)
+
+    def test_output_tail(self):
+        # A couple of megabytes of deploy log
+        self.deployment.output = ''.join('[web1] run: step {}\n'.format(i) for i in range(100000))
+        self.deployment.save()
+
+        self.hook.output_tail = 10000
+        self.hook.save()
+
+        # Hooks get all of it unless they ask for a tail
+        full_hook = mommy.make(hook_models.Hook, project=self.deployment.stage.project, url=self.server.url + 'full/')
+        self.assertIsNone(full_hook.output_tail)
+
+        finish_deployment(self.deployment)
+
+        tail_body, full_body = self.server.received
+        tail, full = json.loads(tail_body), json.loads(full_body)
+
+        self.assertEqual(full['output'], self.deployment.output)
+        self.assertFalse(full['output_truncated'])
+
+        self.assertTrue(tail['output_truncated'])
+        self.assertLessEqual(len(tail['output']), self.hook.output_tail)
+        self.assertTrue(tail['output'].startswith('[web1] run: step '))
+        self.assertTrue(self.deployment.output.endswith(tail['output']))
+
+        # The bytes each hook got sent
+        self.assertLess(len(tail_body) * 100, len(full_body))
+
+        # No link to the rest without knowing where it is served
+        self.assertIsNone(tail['output_url'])
+
+    def test_output_url(self):
+        log_path = reverse('projects_deployment_log',
+                           args=(self.deployment.stage.project.pk, self.deployment.stage.pk, self.deployment.pk))
+        self.deployment.output = 'All done\n'
+        self.deployment.save()
+
+        with self.settings(HOOK_BASE_URL='https://bolt.example.com/'):
+            finish_deployment(self.deployment)
+
+        output_url = json.loads(self.server.received[0])['output_url']
+        self.assertTrue(output_url.startswith('https://bolt.example.com' + log_path + '?token='))
+
+        # Hooks don't have to log in to fetch it
+        result = self.client.get(output_url[len('https://bolt.example.com'):])
+        self.assertEqual(result.content, self.deployment.output)
+
+        # Anybody else does
+        result = self.client.get(log_path + '?token=forged')
+        self.assertEqual(result.status_code, 302)
+
+        other = mommy.make(models.Deployment, stage=self.deployment.stage, output='Secret\n')
+        other_path = reverse('projects_deployment_log', args=(other.stage.project.pk, other.stage.pk, other.pk))
+        result = self.client.get(other_path + output_url[output_url.index('?'):])
+        self.assertEqual(result.status_code, 302)
+
+        with self.settings(HOOK_OUTPUT_URL_MAX_AGE=-1):
+            self.assertEqual(self.client.get(output_url[len('https://bolt.example.com'):]).status_code, 302)
+
+    def test_retries(self):
+        self.server.status_code = 500
+        delivery = queue_delivery(self.hook, self.deployment, {'id': self.deployment.pk})
+
+        self.assertTrue(attempt_delivery(delivery))
+        delivery = hook_models.HookDelivery.objects.get(pk=delivery.pk)
+        self.assertEqual((delivery.status, delivery.attempts), (hook_models.HookDelivery.PENDING, 1))
+        self.assertGreater(delivery.next_attempt, timezone.now() + timedelta(seconds=25))
+
+        # Not due yet
+        self.assertFalse(attempt_delivery(delivery))
+
+        hook_models.HookDelivery.objects.update(next_attempt=timezone.now())
+        with self.settings(HOOK_MAX_ATTEMPTS=2):
+            self.assertTrue(attempt_delivery(hook_models.HookDelivery.objects.get(pk=delivery.pk)))
+
+        delivery = hook_models.HookDelivery.objects.get(pk=delivery.pk)
+        self.assertEqual((delivery.status, delivery.attempts), (hook_models.HookDelivery.DEAD, 2))
+        self.assertEqual([attempt.status_code for attempt in delivery.attempt_set.all()], [500, 500])
+
+        self.assertEqual(get_retry_delay(1), timedelta(seconds=30))
+        self.assertEqual(get_retry_delay(3), timedelta(seconds=120))
+        self.assertEqual(get_retry_delay(20), timedelta(hours=1))
+
+    def test_deliver_web_hooks_command(self):
+        due = queue_delivery(self.hook, self.deployment, {'id': 1})
+        later = queue_delivery(self.hook, self.deployment, {'id': 2})
+        hook_models.HookDelivery.objects.filter(pk=later.pk).update(next_attempt=timezone.now() + timedelta(hours=1))
+
+        call_command('deliver_web_hooks', once=True)
+
+        self.assertEqual(hook_models.HookDelivery.objects.get(pk=due.pk).status, hook_models.HookDelivery.DELIVERED)
+        self.assertEqual(hook_models.HookDelivery.objects.get(pk=later.pk).status, hook_models.HookDelivery.PENDING)
+        self.assertEqual(self.server.received, ['{"id": 1}'])
+
+    def test_prune_deliveries(self):
+        old = timezone.now() - timedelta(days=31)
+        deliveries = dict((status, queue_delivery(self.hook, self.deployment, {'status': status}))
+                          for status in ('delivered', 'dead', 'pending', 'recent'))
+
+        for status in ('delivered', 'dead', 'pending'):
+            hook_models.HookDelivery.objects.filter(pk=deliveries[status].pk).update(date_created=old)
+        for status in ('delivered', 'dead', 'recent'):
+            hook_models.HookDelivery.objects.filter(pk=deliveries[status].pk).update(
+                status=hook_models.HookDelivery.DEAD if status == 'dead' else hook_models.HookDelivery.DELIVERED)
+            mommy.make(hook_models.HookDeliveryAttempt, delivery=deliveries[status], duration=0.1)
+
+        self.assertEqual(prune_deliveries(batch_size=1), 2)
+
+        # Pending ones are still being delivered, however old
+        self.assertEqual(set(hook_models.HookDelivery.objects.values_list('pk', flat=True)),
+                         set([deliveries['pending'].pk, deliveries['recent'].pk]))
+        self.assertEqual(hook_models.HookDeliveryAttempt.objects.get().delivery_id, deliveries['recent'].pk)
+
+        with self.settings(HOOK_DELIVERY_RETENTION=None):
+            hook_models.HookDelivery.objects.update(status=hook_models.HookDelivery.DELIVERED, date_created=old)
+            self.assertEqual(prune_deliveries(), 0)
+
+    def test_batches(self):
+        self.hook.batch_window = 60
+        self.hook.batch_size = 2
+        self.hook.save()
+
+        deployments = [self.deployment] + mommy.make(models.Deployment, stage=self.deployment.stage,
+                                                     status=models.Deployment.FAILED, _quantity=2)
+        for deployment in deployments:
+            finish_deployment(deployment)
+
+        # Nothing is sent until the window has passed
+        self.assertEqual(self.server.received, [])
+        self.assertEqual(deliver_due(), 0)
+
+        first = hook_models.HookDelivery.objects.get(deployment=deployments[0])
+        hook_models.HookDelivery.objects.filter(pk=first.pk).update(next_attempt=timezone.now())
+
+        self.assertEqual(deliver_due(), 1)
+
+        self.assertEqual(len(self.server.received), 1)
+        self.assertEqual([payload['id'] for payload in json.loads(self.server.received[0])],
+                         [deployment.pk for deployment in deployments[:2]])
+
+        statuses = [hook_models.HookDelivery.objects.get(deployment=deployment).status for deployment in deployments]
+        self.assertEqual(statuses, [hook_models.HookDelivery.DELIVERED] * 2 + [hook_models.HookDelivery.PENDING])
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(10, max_wait=0.05)
+
+        self.assertTrue(limiter.acquire('http://example.com/a/'))
+        self.assertFalse(limiter.acquire('http://example.com/b/'))
+        self.assertTrue(limiter.acquire('http://example.org/'))
+
+        time.sleep(0.1)
+        self.assertTrue(limiter.acquire('http://example.com/a/'))
@@ -9,18 +9,21 @@
 # AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
 # PERFORMANCE OF THIS SOFTWARE.
 
-import requests
 import json
+import urllib
 
 from django.conf import settings
 from django.core import serializers
 from django.core.urlresolvers import reverse
 
-if getattr(settings, 'HOOK_THREADING', True):
-    from .client import Client
-    client = Client()
-else:
-    client = requests
+from fabric_bolt.projects.util import get_deployment_log_token
+
+from .client import Client
+
+client = Client(
+    num_threads=getattr(settings, 'HOOK_THREADS', 3) if getattr(settings, 'HOOK_THREADING', True) else 0,
+    timeout=getattr(settings, 'HOOK_TIMEOUT', (5, 30)),
+)
 
 def get_module(path):
     """
@@ -87,6 +90,21 @@ def deliver_hook(instance, target, payload_override=None):
     return None
 
 
+def get_output_url(deployment):
+    """
+    Absolute URL of the full output of a deployment, with a token to fetch it without logging in. None unless
+    HOOK_BASE_URL is set.
+    """
+
+    if not settings.HOOK_BASE_URL:
+        return None
+
+    path = reverse('projects_deployment_log', args=(deployment.stage.project.pk, deployment.stage.pk, deployment.pk,))
+
+    return '{}{}?{}'.format(settings.HOOK_BASE_URL.rstrip('/'), path,
+                            urllib.urlencode({'token': get_deployment_log_token(deployment)}))
+
+
 def get_payload(deployment):
 
     return {
@@ -107,6 +125,8 @@ def get_payload(deployment):
             "email": deployment.user.email
         },
         "output": deployment.output,
+        "output_truncated": False,
+        "output_url": get_output_url(deployment),
         "date_created": '',
         "configuration": '',
         "stage": {
@@ -117,6 +137,27 @@ def get_payload(deployment):
     }
 
 
+def tail_output(payload, tail_size):
+    """
+    The payload with only the last tail_size characters of the deployment output, from the start of a line. Payloads
+    without output, or with less than that, are returned as they are.
+    """
+
+    output = payload.get('output')
+
+    if tail_size is None or not output or len(output) <= tail_size:
+        return payload
+
+    tail = output[-tail_size:]
+
+    # Don't start half way through a line
+    newline = tail.find('\n')
+    if 0 <= newline < len(tail) - 1:
+        tail = tail[newline + 1:]
+
+    return dict(payload, output=tail, output_truncated=True)
+
+
 if getattr(settings, 'DEPLOYMENT_FINISHED_PAYLOAD_GENERATOR', False):
     payload_generator = settings.DEPLOYMENT_FINISHED_PAYLOAD_GENERATOR
 else:
@@ -60,6 +60,13 @@ class HookDetail(DetailView):
 
     model = models.Hook
 
+    def get_context_data(self, **kwargs):
+        context = super(HookDetail, self).get_context_data(**kwargs)
+
+        context['deliveries'] = self.object.deliveries.prefetch_related('attempt_set')[:20]
+
+        return context
+
 
 class HookUpdate(MultipleGroupRequiredMixin, UpdateView):
     """